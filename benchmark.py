@@ -0,0 +1,361 @@
+from contextlib import redirect_stdout
+from mock_server import MockOpenAIServer, complete_batch
+from pathlib import Path
+from rate_limit import RateLimiter
+import argparse
+import asyncio
+import hashlib
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import numpy as np
+
+# Reproducible performance benchmarks for all three pipeline stages, runnable
+# offline on a plain CPU box:
+#
+# * outlines: enumerating every outline of plotgen.lp for several num_scenes
+# * sample: drawing outlines on demand from plotgen.lp, checking on a small
+#   num_scenes that the draws are as close to uniform as truly uniform ones
+# * select: building the outline feature index and picking a diverse batch
+#   of outlines from it, over synthetic sets of up to millions of outlines
+# * stories: end-to-end concurrent story generation against the bundled mock
+#   OpenAI server (mock_server.py), with tunable latency and error injection
+# * wavefront: a whole batch-file run, with every wave answered offline by the
+#   mock server and checked as it is ingested
+# * eval: homogeneity evaluation over synthetic story corpora, using a
+#   deterministic hashing encoder in place of the real embedding model
+#
+# Results are written as JSON so runs can be compared over time:
+#
+#   python3 benchmark.py --output before.json
+#   python3 benchmark.py --output after.json --compare before.json
+
+repo_dir = Path(__file__).resolve().parent
+
+def result(stage, params, seconds, items, unit):
+	return {"stage": stage, "params": params, "seconds": seconds, "items": items, "throughput": items / seconds, "unit": unit}
+
+# run `fn` `repeat` times and return (best time in seconds, fn's last result)
+def best_of(repeat, fn):
+	best = float("inf")
+	for _ in range(repeat):
+		start = time.perf_counter()
+		value = fn()
+		best = min(best, time.perf_counter() - start)
+	return best, value
+
+### Outline enumeration
+
+def bench_outlines(scene_counts, threads, repeat):
+	from gen_outlines import generate_outlines
+	results = []
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		for num_scenes in scene_counts:
+			for thread_count in threads:
+				store_path = str(Path(tmp_dir) / "outlines.bin")
+				seconds, count = best_of(repeat, lambda: generate_outlines(store_path, None, thread_count, num_scenes))
+				results.append(result("outlines", {"num_scenes": num_scenes, "threads": thread_count}, seconds, count, "outlines/s"))
+				print(f"outlines num_scenes={num_scenes} threads={thread_count}: {count} in {seconds:.2f}s")
+	return results
+
+### Outline sampling
+
+# total variation distance between the frequencies of `draws` and the
+# uniform distribution over `outlines`
+def uniform_distance(draws, outlines):
+	counts = {key: 0 for key in outlines}
+	for key in draws:
+		counts[key] += 1
+	return 0.5 * sum(abs(count / len(draws) - 1 / len(outlines)) for count in counts.values())
+
+# draw `num_draws` outlines of `num_scenes` scenes from the sampler and check
+# their frequencies against full enumeration: they should be about as far
+# from uniform as the same number of truly uniform draws
+def bench_sample(num_scenes, num_draws, repeat):
+	from gen_outlines import generate_outlines
+	from outline_sampler import OutlineSampler
+	from outline_store import OutlineStore
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		store_path = str(Path(tmp_dir) / "outlines.bin")
+		generate_outlines(store_path, None, 1, num_scenes)
+		store = OutlineStore(store_path)
+		outlines = [",".join(outline) for outline in store]
+		store.close()
+	def draw():
+		sampler = OutlineSampler(seed=0)
+		return [",".join(outline) for _ in range(num_draws) for outline in sampler.sample(num_scenes=num_scenes, unique=False)]
+	seconds, draws = best_of(repeat, draw)
+	distance = uniform_distance(draws, outlines)
+	rng = random.Random(0)
+	noise = max(uniform_distance(rng.choices(outlines, k=num_draws), outlines) for _ in range(5))
+	print(f"sample num_scenes={num_scenes}: {num_draws} draws in {seconds:.2f}s, distance from uniform {distance:.3f} (uniform draws: up to {noise:.3f})")
+	if distance > 1.2 * noise:
+		raise RuntimeError(f"sampled outlines are {distance:.3f} from uniform, but uniform draws are at most {noise:.3f}")
+	return [result("sample", {"num_scenes": num_scenes, "draws": num_draws}, seconds, num_draws, "outlines/s")]
+
+### Diverse outline selection
+
+# random outline store code matrix with plotgen.lp's shape: 7 scenes and 14
+# functions, where function 1 introduces one of 6 personalities and
+# function 2 one of 5 obstacle types
+def synthetic_outline_codes(num_outlines, num_scenes=7, seed=0):
+	rng = np.random.default_rng(seed)
+	functions = rng.integers(1, 15, size=(num_outlines, num_scenes), dtype=np.uint8)
+	codes = np.zeros((num_outlines, 2 * num_scenes), dtype=np.uint8)
+	codes[:, 0::2] = functions
+	codes[:, 1::2] = np.where(functions == 1, rng.integers(15, 21, size=functions.shape), 0)
+	codes[:, 1::2] += np.where(functions == 2, rng.integers(21, 26, size=functions.shape), 0).astype(np.uint8)
+	return codes
+
+def bench_select(sizes, k, repeat):
+	from outline_index import OutlineIndex
+	results = []
+	for num_outlines in sizes:
+		codes = synthetic_outline_codes(num_outlines)
+		seconds, index = best_of(repeat, lambda: OutlineIndex.from_codes(codes))
+		results.append(result("select", {"outlines": num_outlines, "phase": "index"}, seconds, num_outlines, "outlines/s"))
+		print(f"index outlines={num_outlines}: {seconds:.2f}s")
+		seconds, _ = best_of(repeat, lambda: index.select(k, random.Random(0)))
+		results.append(result("select", {"outlines": num_outlines, "k": k}, seconds, k, "picks/s"))
+		print(f"select outlines={num_outlines} k={k}: {seconds:.3f}s")
+	return results
+
+### Story generation
+
+def bench_stories(concurrency_levels, num_premises, num_stories, latency, error_rate, repeat):
+	import gen_stories
+	from outline_sampler import OutlineSampler
+	os.environ.setdefault("OPENAI_API_KEY", "mock")
+	server = MockOpenAIServer(latency=latency, error_rate=error_rate).start()
+	gen_stories.oai_base_url = server.base_url
+	gen_stories.all_outlines = None
+	gen_stories.outline_sampler = OutlineSampler(seed=0)
+	premises = [f"benchmark premise {n}" for n in range(num_premises)]
+	results = []
+	old_dir = os.getcwd()
+	run_numbers = itertools.count()
+	try:
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			os.chdir(tmp_dir)
+			for concurrency in concurrency_levels:
+				def run():
+					# the async client is tied to the event loop it was first used on
+					gen_stories.oai_async_client = None
+					before = server.requests
+					with redirect_stdout(io.StringIO()):
+						# a fresh run each time, so nothing is resumed from checkpoints
+						story_run = gen_stories.start_run(f"bench-{next(run_numbers)}", premises, num_stories, seed=0)
+						asyncio.run(gen_stories.gen_run_async(story_run, RateLimiter(concurrency)))
+					return server.requests - before
+				seconds, requests = best_of(repeat, run)
+				params = {
+					"concurrency": concurrency, "premises": num_premises, "stories": num_stories,
+					"latency": latency, "error_rate": error_rate
+				}
+				results.append(result("stories", params, seconds, 2 * num_premises * num_stories, "stories/s"))
+				print(f"stories concurrency={concurrency}: {2 * num_premises * num_stories} stories ({requests} requests) in {seconds:.2f}s")
+	finally:
+		os.chdir(old_dir)
+		server.stop()
+	return results
+
+### Wavefront batch generation
+
+# export and ingest every wave of the wavefront run in `run_dir`, answering
+# each one offline with mock results, and check that the run comes out right:
+# results files are only accepted for their own wave, and every finished
+# story on disk holds exactly the paragraphs generated for it. returns the
+# number of waves the run took. without errors, that's one per paragraph of
+# the longest story, plus one for a story that opens with the paragraph that
+# needs its premise's obstacle hint, since it can't start before the hint
+def run_waves_offline(run_dir, error_rate=0.0, rng=random):
+	import gen_stories
+	def rejected(results_path):
+		try:
+			gen_stories.ingest_wave(run_dir, results_path)
+		except ValueError:
+			return True
+		return False
+	previous = None
+	while True:
+		wave_path = gen_stories.export_wave(run_dir)
+		if wave_path is None:
+			break
+		if previous is not None and not rejected(previous):
+			raise RuntimeError(f"{previous} was ingested into the wrong wave")
+		results_path = wave_path.with_name(f"{wave_path.stem}_results.jsonl")
+		complete_batch(wave_path, results_path, error_rate, rng=rng)
+		gen_stories.ingest_wave(run_dir, results_path)
+		previous = results_path
+	if previous is not None and not rejected(previous):
+		raise RuntimeError(f"{previous} was ingested with no wave pending")
+	state = gen_stories.load_wave_state(run_dir)
+	output_dirs = {info["premise"]: info["output_dir"] for info in state["premises"]}
+	for story in state["stories"]:
+		if len(story["paragraphs"]) != len(story["prompts"]):
+			raise RuntimeError(f"story {story['premise']}/{story['kind']}/{story['index']} is unfinished")
+		with open(f"./stories/{output_dirs[story['premise']]}/{story['kind']}/{story['index']}.txt") as story_file:
+			if story_file.read() != "\n".join(story["paragraphs"]):
+				raise RuntimeError(f"story {story['premise']}/{story['kind']}/{story['index']} was written wrongly")
+	expected = max(
+		len(story["prompts"]) + (story["kind"] == "guided" and story["outline"][0] == "add_obstacle_towards_major_goal")
+		for story in state["stories"]
+	)
+	if error_rate == 0 and state["wave"] != expected:
+		raise RuntimeError(f"the run took {state['wave']} waves instead of {expected}")
+	return state["wave"]
+
+def bench_wavefront(num_premises, num_stories, error_rate, repeat):
+	import gen_stories
+	from outline_sampler import OutlineSampler
+	gen_stories.all_outlines = None
+	gen_stories.outline_sampler = OutlineSampler(seed=0)
+	premises = [f"benchmark premise {n}" for n in range(num_premises)]
+	old_dir = os.getcwd()
+	run_numbers = itertools.count()
+	try:
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			os.chdir(tmp_dir)
+			def run():
+				run_dir = f"wave-run-{next(run_numbers)}"
+				with redirect_stdout(io.StringIO()):
+					gen_stories.init_wave_run(run_dir, premises, num_stories, seed=0)
+					return run_waves_offline(run_dir, error_rate, random.Random(0))
+			seconds, waves = best_of(repeat, run)
+	finally:
+		os.chdir(old_dir)
+	params = {"premises": num_premises, "stories": num_stories, "error_rate": error_rate}
+	print(f"wavefront: {2 * num_premises * num_stories} stories in {waves} waves, {seconds:.2f}s")
+	return [result("wavefront", params, seconds, 2 * num_premises * num_stories, "stories/s")]
+
+### Homogeneity evaluation
+
+# Deterministic stand-in for the sentence embedding model: hashes each word
+# of a passage into a fixed-size bag-of-words vector. Costs far less than
+# the real model, but exercises exactly the same evaluation code.
+class HashingEncoder:
+	def __init__(self, dim=384):
+		self.dim = dim
+
+	def get_sentence_embedding_dimension(self):
+		return self.dim
+
+	def encode(self, passages, batch_size=64, convert_to_numpy=True):
+		embeddings = np.zeros((len(passages), self.dim), dtype=np.float32)
+		for row, passage in enumerate(passages):
+			for word in passage.split():
+				digest = hashlib.blake2b(word.encode("utf-8"), digest_size=4).digest()
+				embeddings[row, int.from_bytes(digest, "little") % self.dim] += 1
+		return embeddings
+
+def synthetic_corpus(num_stories, num_passages=7, words_per_passage=60, seed=0):
+	rng = random.Random(seed)
+	vocabulary = [f"word{n}" for n in range(2000)]
+	return [
+		[" ".join(rng.choices(vocabulary, k=words_per_passage)) for _ in range(num_passages)]
+		for _ in range(num_stories)
+	]
+
+def bench_eval(corpus_sizes, real_model, repeat):
+	import eval as evaluation
+	from embedding_store import EmbeddingStore
+	if not real_model:
+		evaluation.model = HashingEncoder()
+	results = []
+	for num_stories in corpus_sizes:
+		stories = synthetic_corpus(num_stories)
+		params = {"stories": num_stories, "model": "real" if real_model else "hashing"}
+		seconds, _ = best_of(repeat, lambda: evaluation.evaluate_homogeneity(stories))
+		results.append(result("eval", params, seconds, num_stories, "stories/s"))
+		print(f"eval stories={num_stories}: {seconds:.2f}s")
+		# the same corpus again, with every embedding already in the store
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			store = EmbeddingStore(tmp_dir, evaluation.MODEL_NAME)
+			with redirect_stdout(io.StringIO()):
+				evaluation.evaluate_homogeneity(stories, store=store)
+			seconds, _ = best_of(repeat, lambda: evaluation.evaluate_homogeneity(stories, store=store))
+		results.append(result("eval", {**params, "store": "warm"}, seconds, num_stories, "stories/s"))
+		print(f"eval stories={num_stories} (warm store): {seconds:.2f}s")
+	return results
+
+### Results
+
+def metadata():
+	try:
+		commit = subprocess.run(
+			["git", "rev-parse", "HEAD"], cwd=repo_dir, capture_output=True, text=True
+		).stdout.strip()
+	except OSError:
+		commit = None
+	return {
+		"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"commit": commit or None,
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"cpus": os.cpu_count(),
+	}
+
+def result_key(result):
+	return result["stage"], json.dumps(result["params"], sort_keys=True)
+
+# print each result's throughput relative to the matching result in `baseline`
+def compare(results, baseline):
+	previous = {result_key(result): result for result in baseline["results"]}
+	print(f"\nCompared to {baseline['meta'].get('commit') or baseline['meta']['time']}:")
+	for result in results:
+		old = previous.get(result_key(result))
+		if old is None:
+			continue
+		ratio = result["throughput"] / old["throughput"]
+		print(f"  {result['stage']} {result['params']}: {ratio:.2f}x ({old['throughput']:.1f} -> {result['throughput']:.1f} {result['unit']})")
+
+def main(argv=None, prog=None):
+	parser = argparse.ArgumentParser(prog=prog, description="Benchmark the outline, story and eval stages.")
+	parser.add_argument("--stages", nargs="+", choices=["outlines", "sample", "select", "stories", "wavefront", "eval"], default=["outlines", "sample", "select", "stories", "wavefront", "eval"])
+	parser.add_argument("--output", default="bench_results.json", help="where to write the JSON results")
+	parser.add_argument("--compare", help="earlier results file to compare against")
+	parser.add_argument("--repeat", type=int, default=1, help="runs per benchmark; the fastest is kept")
+	parser.add_argument("--scenes", type=int, nargs="+", default=[4, 5, 6], help="num_scenes values to enumerate")
+	parser.add_argument("--threads", type=int, nargs="+", default=[1], help="clingo thread counts to enumerate with")
+	parser.add_argument("--sample-scenes", type=int, default=5, help="num_scenes to check sampling uniformity at")
+	parser.add_argument("--sample-draws", type=int, default=4000, help="outlines to draw when checking sampling uniformity")
+	parser.add_argument("--select-sizes", type=int, nargs="+", default=[100000, 1000000, 4000000], help="outline counts to select diverse batches from")
+	parser.add_argument("--select-k", type=int, default=10, help="outlines per diverse batch")
+	parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32], help="concurrency levels for story generation")
+	parser.add_argument("--premises", type=int, default=2, help="premises per story generation run")
+	parser.add_argument("--stories", type=int, default=4, help="stories per premise")
+	parser.add_argument("--latency", type=float, default=0.05, help="mock server seconds per response")
+	parser.add_argument("--error-rate", type=float, default=0.02, help="fraction of mock responses that fail")
+	parser.add_argument("--corpus-sizes", type=int, nargs="+", default=[10, 1000, 10000], help="synthetic corpus sizes for eval")
+	parser.add_argument("--real-model", action="store_true", help="evaluate with the real embedding model instead of the hashing encoder")
+	args = parser.parse_args(argv)
+
+	results = []
+	if "outlines" in args.stages:
+		results += bench_outlines(args.scenes, args.threads, args.repeat)
+	if "sample" in args.stages:
+		results += bench_sample(args.sample_scenes, args.sample_draws, args.repeat)
+	if "select" in args.stages:
+		results += bench_select(args.select_sizes, args.select_k, args.repeat)
+	if "stories" in args.stages:
+		results += bench_stories(args.concurrency, args.premises, args.stories, args.latency, args.error_rate, args.repeat)
+	if "wavefront" in args.stages:
+		results += bench_wavefront(args.premises, args.stories, args.error_rate, args.repeat)
+	if "eval" in args.stages:
+		results += bench_eval(args.corpus_sizes, args.real_model, args.repeat)
+
+	with open(args.output, "w") as output_file:
+		json.dump({"meta": metadata(), "results": results}, output_file, indent=2)
+	print(f"Wrote {args.output}")
+	if args.compare:
+		with open(args.compare) as baseline_file:
+			compare(results, json.load(baseline_file))
+
+if __name__ == "__main__":
+	main()
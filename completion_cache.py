@@ -0,0 +1,95 @@
+import hashlib
+import json
+import sqlite3
+import time
+
+# how a CompletionCache is consulted:
+# * "read-through": return cached responses, and call the API (and record
+#   the response) on a miss
+# * "record": always call the API, recording every response
+# * "replay": only ever return cached responses; a miss raises CacheMiss,
+#   so runs are guaranteed to be offline and free
+# * "off": don't use the cache at all
+CACHE_MODES = ("read-through", "record", "replay", "off")
+
+class CacheMiss(Exception):
+	pass
+
+# Content-addressed key for a completion request: a hash of the full request
+# body (model, messages and any sampling parameters) plus an optional
+# `variant`. Requests that should be sampled independently even when their
+# bodies are identical (e.g. the first paragraph of two different stories)
+# pass different variants. Responses from an `endpoint` other than the real
+# OpenAI API (e.g. a local mock server) are keyed separately, so they're
+# never mistaken for the real model's.
+def request_key(request, variant=None, endpoint=None):
+	key_parts = [request, variant] if endpoint is None else [request, variant, endpoint.rstrip("/")]
+	payload = json.dumps(key_parts, sort_keys=True, separators=(",", ":"))
+	return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+# A persistent, size-bounded cache of completion texts stored in a single
+# SQLite file. When the stored text exceeds `max_bytes`, the least recently
+# used entries are evicted until it's back under 90% of the limit.
+class CompletionCache:
+	def __init__(self, path="completion_cache.sqlite", mode="read-through", max_bytes=512 * 1024 * 1024):
+		if mode not in CACHE_MODES:
+			raise ValueError(f"unknown cache mode: {mode}")
+		self.path = path
+		self.mode = mode
+		self.max_bytes = max_bytes
+		self.db = sqlite3.connect(path)
+		self.db.execute(
+			"CREATE TABLE IF NOT EXISTS completions ("
+			"key TEXT PRIMARY KEY, content TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+		)
+		self.db.execute("CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)")
+		self.db.commit()
+		self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+		self.hits = 0
+		self.misses = 0
+
+	# whether the API should be skipped in favour of a cached response
+	def reads(self):
+		return self.mode in ("read-through", "replay")
+
+	# whether fresh API responses should be stored
+	def writes(self):
+		return self.mode in ("read-through", "record")
+
+	def get(self, key):
+		row = self.db.execute("SELECT content FROM completions WHERE key = ?", (key,)).fetchone()
+		if row is None:
+			self.misses += 1
+			if self.mode == "replay":
+				raise CacheMiss(key)
+			return None
+		self.hits += 1
+		self.db.execute("UPDATE completions SET last_used = ? WHERE key = ?", (time.time(), key))
+		self.db.commit()
+		return row[0]
+
+	def put(self, key, content):
+		size = len(content.encode("utf-8"))
+		old = self.db.execute("SELECT size FROM completions WHERE key = ?", (key,)).fetchone()
+		self.db.execute(
+			"INSERT OR REPLACE INTO completions (key, content, size, last_used) VALUES (?, ?, ?, ?)",
+			(key, content, size, time.time())
+		)
+		self.size += size - (old[0] if old else 0)
+		if self.size > self.max_bytes:
+			self.evict(int(self.max_bytes * 0.9))
+		self.db.commit()
+
+	# drop least recently used entries until at most `target_bytes` remain
+	def evict(self, target_bytes):
+		rows = self.db.execute("SELECT key, size FROM completions ORDER BY last_used")
+		evicted = []
+		for key, size in rows:
+			if self.size <= target_bytes:
+				break
+			evicted.append((key,))
+			self.size -= size
+		self.db.executemany("DELETE FROM completions WHERE key = ?", evicted)
+
+	def close(self):
+		self.db.close()
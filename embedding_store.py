@@ -0,0 +1,83 @@
+from pathlib import Path
+import hashlib
+import json
+import numpy as np
+
+# Persistent, append-only store of passage embeddings for one embedding
+# model, so each passage only ever has to be embedded once.
+#
+# A store is a directory holding:
+# * vectors.f32: every embedding as raw float32 rows, memory-mapped on load
+# * keys.bin: the offsets table, one 32-byte SHA-256 key per row (in row
+#   order), hashing the model name together with the passage text
+# * meta.json: the model name and embedding dimension
+#
+# Rows are only ever appended, vectors before keys, so a crash mid-write
+# leaves at worst a few orphaned vectors that are ignored on the next load.
+
+KEY_SIZE = 32
+
+class EmbeddingStore:
+	def __init__(self, path, model_name):
+		self.path = Path(path)
+		self.model_name = model_name
+		self.path.mkdir(parents=True, exist_ok=True)
+		meta_path = self.path / "meta.json"
+		self.dim = None
+		if meta_path.exists():
+			with open(meta_path) as meta_file:
+				meta = json.load(meta_file)
+			if meta["model"] != model_name:
+				raise ValueError(f"{path} holds embeddings from {meta['model']}, not {model_name}")
+			self.dim = meta["dim"]
+		self.load()
+
+	def load(self):
+		keys_path = self.path / "keys.bin"
+		keys = keys_path.read_bytes() if keys_path.exists() else b""
+		num_rows = len(keys) // KEY_SIZE
+		vectors_path = self.path / "vectors.f32"
+		if self.dim and vectors_path.exists():
+			num_rows = min(num_rows, vectors_path.stat().st_size // (4 * self.dim))
+		self.rows = {keys[i * KEY_SIZE:(i + 1) * KEY_SIZE]: i for i in range(num_rows)}
+		self.vectors = None
+		if num_rows:
+			self.vectors = np.memmap(vectors_path, dtype=np.float32, mode="r", shape=(num_rows, self.dim))
+
+	def __len__(self):
+		return len(self.rows)
+
+	def key(self, text):
+		return hashlib.sha256(f"{self.model_name}\0{text}".encode("utf-8")).digest()
+
+	# return the distinct `texts` that don't have a stored embedding yet
+	def missing(self, texts):
+		return list(dict.fromkeys(text for text in texts if self.key(text) not in self.rows))
+
+	# append `embeddings` (one row per text in `texts`) to the store
+	def add(self, texts, embeddings):
+		if not texts:
+			return
+		embeddings = np.asarray(embeddings, dtype=np.float32)
+		if self.dim is None:
+			self.dim = embeddings.shape[1]
+			with open(self.path / "meta.json", "w") as meta_file:
+				json.dump({"model": self.model_name, "dim": self.dim}, meta_file)
+		# drop any orphaned vectors left behind by an interrupted write
+		with open(self.path / "vectors.f32", "ab") as vectors_file:
+			vectors_file.truncate(len(self.rows) * 4 * self.dim)
+			vectors_file.write(embeddings.tobytes())
+		with open(self.path / "keys.bin", "ab") as keys_file:
+			keys_file.truncate(len(self.rows) * KEY_SIZE)
+			keys_file.write(b"".join(self.key(text) for text in texts))
+		self.load()
+
+	# return the stored row numbers for `texts`, all of which must be stored
+	def row_numbers(self, texts):
+		return np.fromiter((self.rows[self.key(text)] for text in texts), dtype=np.int64, count=len(texts))
+
+	# return the stored embeddings for `texts` as one (len(texts), dim) array
+	def lookup(self, texts):
+		if not texts:
+			return np.zeros((0, self.dim or 0), dtype=np.float32)
+		return self.vectors[self.row_numbers(texts)]
@@ -1,43 +1,188 @@
+from embedding_store import EmbeddingStore
 from pathlib import Path
-from sentence_transformers import SentenceTransformer, util
-from statistics import mean
+import argparse
 import numpy as np
+import tracing
+import worker
 
-model = SentenceTransformer("all-MiniLM-L6-v2")
-
-# Given a list of individual item `embeddings` and a precomputed
-# `center` embedding for the whole list, return a list containing the
-# semantic similarities of each item to the center.
-def similarities_to_center(embeddings, center):
-	return [sim[0].item() for sim in util.cos_sim(embeddings, [center])]
-
-# Given a list of `stories`, each one of which is a list of `n` passages,
-# return a list of `n` overall homogeneity scores: one for each passage index
-# from `0..n`. Homogeneity scores will range from 0 (all passages fully unique)
-# to 1 (all passages fully identical).
-def evaluate_homogeneity(stories):
-	homogeneity_scores = []
-	for n in range(len(stories[0])):
-		nth_passages = [story[n] for story in stories]
-		passage_embs = [model.encode(passage) for passage in nth_passages]
-		central_emb = np.mean(passage_embs, axis=0)
-		similarity_scores = similarities_to_center(passage_embs, central_emb)
-		homogeneity_scores.append(mean(similarity_scores))
-	return homogeneity_scores
+MODEL_NAME = "all-MiniLM-L6-v2"
+
+# the embedding model is loaded on first use, so runs where every passage
+# is already in the embedding store never pay for importing torch
+model = None
+
+def get_model():
+	global model
+	if model is None:
+		with tracing.span("load_model", model=MODEL_NAME):
+			from sentence_transformers import SentenceTransformer
+			model = SentenceTransformer(MODEL_NAME)
+	return model
+
+# Flatten a list of `stories` (each a list of passages, not necessarily all
+# the same length) into one list of passages, plus an array giving the
+# passage index (position within its story) of each one.
+def flatten_stories(stories):
+	passages = [passage for story in stories for passage in story]
+	passage_index = np.array([n for story in stories for n in range(len(story))], dtype=np.int64)
+	return passages, passage_index
+
+# Embed every passage in a single `encode` call. sentence-transformers sorts
+# its input by length before batching, so batches are padded as little as
+# possible regardless of how the passages are ordered here.
+def encode_passages(passages, batch_size=64):
+	if not passages:
+		return np.zeros((0, 0), dtype=np.float32)
+	encoder = get_model()
+	with tracing.span("encode", model=MODEL_NAME, passages=len(passages), batch_size=batch_size):
+		return encoder.encode(passages, batch_size=batch_size, convert_to_numpy=True)
+
+# Embed `passages`, reusing any embeddings already in `store` (an
+# EmbeddingStore, or None to always encode). Only passages the store hasn't
+# seen before are encoded, and they're added to the store for next time.
+def embed_passages(passages, store=None, batch_size=64):
+	if store is None:
+		return encode_passages(passages, batch_size)
+	new_passages = store.missing(passages)
+	if new_passages:
+		print(f"Embedding {len(new_passages)} new passages")
+		store.add(new_passages, encode_passages(new_passages, batch_size))
+	return store.lookup(passages)
+
+# Given stacked passage `embeddings` and the `passage_index` of each row,
+# return a list of overall homogeneity scores: one for each passage index
+# from `0..n`, where `n` is the length of the longest story. Each score is
+# the mean cosine similarity of that index's passages to their centroid, and
+# only stories long enough to have a passage at that index contribute to
+# it (indices with no passages at all score NaN). Homogeneity scores will
+# range from 0 (all passages fully unique) to 1 (all passages fully
+# identical).
+def homogeneity_scores(embeddings, passage_index):
+	if len(passage_index) == 0:
+		return []
+	num_indices = passage_index.max() + 1
+	counts = np.bincount(passage_index, minlength=num_indices)
+	# there are only ever a handful of passage indices, so a loop over them
+	# is much cheaper than an unbuffered scatter-add over every row
+	centroids = np.zeros((num_indices, embeddings.shape[1]), dtype=np.float64)
+	for n in range(num_indices):
+		if counts[n]:
+			centroids[n] = embeddings[passage_index == n].mean(axis=0, dtype=np.float64)
+	row_centroids = centroids[passage_index]
+	dots = np.einsum("ij,ij->i", embeddings, row_centroids)
+	norms = np.linalg.norm(embeddings, axis=1) * np.linalg.norm(row_centroids, axis=1)
+	similarities = dots / np.maximum(norms, 1e-12)
+	totals = np.bincount(passage_index, weights=similarities, minlength=num_indices)
+	return np.divide(totals, counts, out=np.full(num_indices, np.nan), where=counts > 0).tolist()
+
+# Given stacked passage `embeddings` and the `passage_index` of each row,
+# return the full pairwise cosine similarity matrix between the passages at
+# each passage index.
+def pairwise_similarities(embeddings, passage_index):
+	if len(passage_index) == 0:
+		return []
+	normalized = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+	matrices = []
+	for n in range(passage_index.max() + 1):
+		nth = normalized[passage_index == n]
+		matrices.append(nth @ nth.T)
+	return matrices
+
+# Given a list of `stories`, each one of which is a list of passages,
+# return a list of homogeneity scores, one per passage index.
+def evaluate_homogeneity(stories, batch_size=64, store=None):
+	passages, passage_index = flatten_stories(stories)
+	return homogeneity_scores(embed_passages(passages, store, batch_size), passage_index)
+
+# Keep only the `passages` at the given passage `indices`
+# (None keeps everything), preserving each passage's original index.
+def select_passages(passages, passage_index, indices=None):
+	if indices is None:
+		return passages, passage_index
+	keep = np.isin(passage_index, list(indices))
+	return [p for p, k in zip(passages, keep) if k], passage_index[keep]
+
+# Embed many story batches at once: every passage of every batch is
+# embedded in one `encode` call (or looked up in `store`). Returns each
+# batch's (embeddings, passage_index); with `indices`, only those passage
+# indices are embedded.
+def embed_batches(batches, batch_size=64, store=None, indices=None):
+	flattened = [select_passages(*flatten_stories(stories), indices) for stories in batches]
+	embeddings = embed_passages([p for passages, _ in flattened for p in passages], store, batch_size)
+	embedded = []
+	start = 0
+	for passages, passage_index in flattened:
+		end = start + len(passages)
+		embedded.append((embeddings[start:end], passage_index))
+		start = end
+	return embedded
+
+# Evaluate many story batches at once (see `embed_batches`). Returns one
+# list of homogeneity scores per batch.
+def evaluate_batches(batches, batch_size=64, store=None, indices=None):
+	return [homogeneity_scores(*embedded) for embedded in embed_batches(batches, batch_size, store, indices)]
+
+# save one batch's pairwise similarity matrices to `path` as an .npz file
+# with one array per passage index ("index_0", "index_1"...)
+def save_pairwise(path, matrices):
+	arrays = {f"index_{n}": matrix for n, matrix in enumerate(matrices) if matrix.size}
+	with open(path, "wb") as file:
+		np.savez(file, **arrays)
 
 def load_story(path):
 	with open(path, "r") as file:
 		return file.readlines()
 
-story_batches_dir = Path("./stories")
-subdirs = [path for path in story_batches_dir.iterdir() if path.is_dir()]
-for subdir in subdirs:
-	premise = subdir.name.split("_")[1]
-	print("Premise:", premise)
-	guided_story_paths = [p for p in Path(subdir / "guided").iterdir()]
-	unguided_story_paths = [p for p in Path(subdir / "unguided").iterdir()]
-	guided_stories = [load_story(p) for p in guided_story_paths]
-	unguided_stories = [load_story(p) for p in unguided_story_paths]
-	print("Guided:", evaluate_homogeneity(guided_stories))
-	print("Unguided:", evaluate_homogeneity(unguided_stories))
-	print()
+def main(argv=None, prog=None):
+	parser = argparse.ArgumentParser(prog=prog, description="Evaluate the homogeneity of generated story batches.")
+	parser.add_argument("--batch-size", type=int, default=64, help="passages per encoder batch")
+	parser.add_argument("--store", default="embeddings", help="embedding store directory, so passages are only ever embedded once")
+	parser.add_argument("--no-store", action="store_true", help="embed every passage from scratch")
+	parser.add_argument("--batch", action="append", help="only evaluate this batch directory name (repeatable)")
+	parser.add_argument("--premise", action="append", help="only evaluate batches for this premise (repeatable)")
+	parser.add_argument("--metrics", help="append JSONL timings for the encoding phase to this file")
+	parser.add_argument("--indices", type=lambda value: [int(n) for n in value.split(",")], help="only score these passage indices, e.g. 0,1,2")
+	parser.add_argument("--worker", nargs="?", const=worker.default_url, metavar="URL", help="evaluate with a running worker (see worker.py), which keeps the model loaded")
+	parser.add_argument("--pairwise", metavar="DIR", help="also save every batch's pairwise passage similarity matrices to DIR/<batch>_<kind>.npz")
+	args = parser.parse_args(argv)
+	if args.pairwise and args.worker:
+		parser.error("--pairwise embeds passages locally, so it can't be used with --worker")
+
+	if args.metrics:
+		tracing.enable(args.metrics)
+	story_batches_dir = Path("./stories")
+	subdirs = [path for path in story_batches_dir.iterdir() if path.is_dir()]
+	if args.batch:
+		subdirs = [path for path in subdirs if path.name in args.batch]
+	if args.premise:
+		subdirs = [path for path in subdirs if path.name.split("_", 1)[1] in args.premise]
+	batches = []
+	batch_names = []
+	for subdir in subdirs:
+		for kind in ("guided", "unguided"):
+			batch_names.append(f"{subdir.name}_{kind}")
+			# skip any half-written .tmp files left by an interrupted run
+			story_paths = sorted(Path(subdir / kind).glob("*.txt"))
+			batches.append([load_story(p) for p in story_paths])
+	if args.worker:
+		scores = worker.evaluate_batches(args.worker, batches, args.batch_size, args.indices)
+	else:
+		store = None if args.no_store else EmbeddingStore(Path(args.store) / MODEL_NAME, MODEL_NAME)
+		embedded = embed_batches(batches, args.batch_size, store, args.indices)
+		scores = [homogeneity_scores(*batch) for batch in embedded]
+		if args.pairwise:
+			Path(args.pairwise).mkdir(parents=True, exist_ok=True)
+			for name, batch in zip(batch_names, embedded):
+				save_pairwise(Path(args.pairwise) / f"{name}.npz", pairwise_similarities(*batch))
+			print(f"Saved pairwise similarities to {args.pairwise}")
+	if args.indices:
+		scores = [[batch_scores[n] for n in args.indices if n < len(batch_scores)] for batch_scores in scores]
+	for n, subdir in enumerate(subdirs):
+		premise = subdir.name.split("_", 1)[1]
+		print("Premise:", premise)
+		print("Guided:", scores[2 * n])
+		print("Unguided:", scores[2 * n + 1])
+		print()
+
+if __name__ == "__main__":
+	main()
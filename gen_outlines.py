@@ -1,79 +1,128 @@
 from clingo.control import Control
+from outline_index import build_index, index_path
+from outline_store import OutlineStore, OutlineWriter
+from pathlib import Path
+import argparse
 import random
+import tracing
 
-#update the generate outline function with new output format
-def generate_outlines():
-	# helper callback to collect valid story outlines as they're generated
-	outlines_file = open("outlines.csv", "w")
-	all_outlines = []
+# the answer set program describing valid outlines, which lives next to
+# this file rather than in whatever directory we're run from
+plotgen_path = Path(__file__).resolve().parent / "plotgen.lp"
 
-	def collect_outline(model):
-		# get shown symbols from the model
-		syms = model.symbols(shown=True)
+# convert the shown symbols of a single answer set into an outline list,
+# e.g. ["introduce_character:cold", "add_twist", ...]
+def outline_from_symbols(syms):
+	# create a dictionary to store scene information
+	scene_info = {}
+
+	# extract the symbols and their arguments
+	for sym in syms:
+		# check if the symbol represents a scene performing a function
+		if sym.name == "scene_performs_function":
+			# extract the scene index from the first argument
+			scene_index = sym.arguments[0].number
+			# extract the function name from the second argument
+			function_name = sym.arguments[1].name
+			# the function name always comes first in the scene's list
+			scene_info.setdefault(scene_index, []).insert(0, function_name)
+		# check if the symbol represents a scene introducing a personality
+		elif sym.name == "scene_introduce_personality":
+			# extract the scene index from the first argument
+			scene_index = sym.arguments[0].number
+			# extract the personality from the second argument
+			personality = sym.arguments[1].name
+			# add the personality to the corresponding scene index in the scene_info dictionary
+			scene_info.setdefault(scene_index, []).append(personality)
+		# check if the symbol represents a scene introducing a obstacle
+		elif sym.name == "scene_define_obstacle_type":
+			# extract the scene index from the first argument
+			scene_index = sym.arguments[0].number
+			# extract the obstacle_type from the second argument
+			obstacle_type = sym.arguments[1].name
+			# add the obstacle_type to the corresponding scene index in the scene_info dictionary
+			scene_info.setdefault(scene_index, []).append(obstacle_type)
 
-		# create a dictionary to store scene information
-		scene_info = {}
+	# create the outline list in the desired format
+	outline = []
+	# iterate over the sorted scene indices in the scene_info dictionary
+	for scene_index in sorted(scene_info.keys()):
+		# get the scene functions and personalities for the current scene index
+		scene_functions = scene_info[scene_index]
+		# check if the scene has more than one function/personality
+		if len(scene_functions) > 1:
+			# join the function name and personality with a colon and append to the outline list
+			outline.append(f"{scene_functions[0]}:{scene_functions[1]}")
+		else:
+			# append the single function name to the outline list
+			outline.append(scene_functions[0])
+	return outline
 
-		# extract the symbols and their arguments
-		for sym in syms:
-			# check if the symbol represents a scene performing a function
-			if sym.name == "scene_performs_function":
-				# extract the scene index from the first argument
-				scene_index = sym.arguments[0].number
-				# extract the function name from the second argument
-				function_name = sym.arguments[1].name
-				# add the function name to the corresponding scene index in the scene_info dictionary
-				scene_info.setdefault(scene_index, []).append(function_name)
-			# check if the symbol represents a scene introducing a personality
-			elif sym.name == "scene_introduce_personality":
-				# extract the scene index from the first argument
-				scene_index = sym.arguments[0].number
-				# extract the personality from the second argument
-				personality = sym.arguments[1].name
-				# add the personality to the corresponding scene index in the scene_info dictionary
-				scene_info.setdefault(scene_index, []).append(personality)
-			# check if the symbol represents a scene introducing a obstacle
-			elif sym.name == "scene_define_obstacle_type":
-				# extract the scene index from the first argument
-				scene_index = sym.arguments[0].number
-				# extract the obstacle_type from the second argument
-				obstacle_type = sym.arguments[1].name
-				# add the obstacle_type to the corresponding scene index in the scene_info dictionary
-				scene_info.setdefault(scene_index, []).append(obstacle_type)
+# build the clingo command-line arguments for an enumeration run.
+# with more than one thread, clingo splits the search space between
+# threads so that each model is still found exactly once
+def clingo_args(threads=1, num_scenes=None):
+	args = []
+	if threads > 1:
+		args.append(f"--parallel-mode={threads},split")
+	if num_scenes is not None:
+		args += ["-c", f"num_scenes={num_scenes}"]
+	return args
 
-		# create the outline list in the desired format
-		outline = []
-		# iterate over the sorted scene indices in the scene_info dictionary
-		for scene_index in sorted(scene_info.keys()):
-			# get the scene functions and personalities for the current scene index
-			scene_functions = scene_info[scene_index]
-			# check if the scene has more than one function/personality
-			if len(scene_functions) > 1:
-				# join the function name and personality with a colon and append to the outline list
-				outline.append(f"{scene_functions[0]}:{scene_functions[1]}")
-			else:
-				# append the single function name to the outline list
-				outline.append(scene_functions[0])
+# enumerate every outline allowed by plotgen.lp, streaming each one into the
+# compact outline store at `store_path` (and optionally a CSV file) as soon
+# as it's found. returns the number of outlines written
+def generate_outlines(store_path="outlines.bin", csv_path=None, threads=1, num_scenes=None, verbose=False):
+	outlines_file = open(csv_path, "w") if csv_path else None
+	store = OutlineWriter(store_path, num_scenes)
 
-		# append the outline list to the all_outlines list
-		all_outlines.append(outline)
-		outlines_file.write(",".join(outline) + "\n")
-		# print the outline for debugging purposes
-		print(outline)
+	# helper callback to collect valid story outlines as they're generated
+	def collect_outline(model):
+		outline = outline_from_symbols(model.symbols(shown=True))
+		store.write(outline)
+		if outlines_file:
+			outlines_file.write(",".join(outline) + "\n")
+		if verbose:
+			# print the outline for debugging purposes
+			print(outline)
 
 	# create a Clingo control object
-	ctl = Control()
+	ctl = Control(clingo_args(threads, num_scenes))
 	# set the configuration to enumerate all models
 	ctl.configuration.solve.models = 0
 	# load the ASP program from the "plotgen.lp" file
-	ctl.load("./plotgen.lp")
+	ctl.load(str(plotgen_path))
 	# ground the ASP program
-	ctl.ground()
+	with tracing.span("clingo_ground", threads=threads, num_scenes=num_scenes):
+		ctl.ground()
 	# solve the ASP program, passing the collect_outline function as a callback for each model
-	ctl.solve(on_model=collect_outline, on_unsat=lambda: print("UNSAT"))
+	with tracing.span("clingo_solve", threads=threads, num_scenes=num_scenes) as fields:
+		ctl.solve(on_model=collect_outline, on_unsat=lambda: print("UNSAT"))
+		fields["models"] = store.num_rows
+
+	# finalize the store when Clingo finishes solving
+	store.close()
+	if outlines_file:
+		outlines_file.close()
+	return store.num_rows
 
-	# return the collected outlines when Clingo finishes solving
-	outlines_file.close()
-	return all_outlines
+def main(argv=None, prog=None):
+	parser = argparse.ArgumentParser(prog=prog, description="Enumerate every story outline allowed by plotgen.lp.")
+	parser.add_argument("--threads", type=int, default=1, help="number of clingo solver threads")
+	parser.add_argument("--num-scenes", type=int, help="override the num_scenes constant in plotgen.lp")
+	parser.add_argument("--store", default="outlines.bin", help="path of the binary outline store to write")
+	parser.add_argument("--csv", nargs="?", const="outlines.csv", help="also write outlines as CSV (default: outlines.csv)")
+	parser.add_argument("--verbose", action="store_true", help="print each outline as it's found")
+	parser.add_argument("--metrics", help="append JSONL timings for grounding and solving to this file")
+	args = parser.parse_args(argv)
+	if args.metrics:
+		tracing.enable(args.metrics)
+	count = generate_outlines(args.store, args.csv, args.threads, args.num_scenes, args.verbose)
+	print(f"Wrote {count} outlines to {args.store}")
+	# precompute the feature index used for diverse outline selection
+	with OutlineStore(args.store) as store:
+		build_index(store, args.store)
+	print(f"Indexed them in {index_path(args.store)}")
 
-generate_outlines()
+if __name__ == "__main__":
+	main()
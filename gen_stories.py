@@ -1,14 +1,106 @@
+from completion_cache import CACHE_MODES, CompletionCache, request_key
 from datetime import datetime
-from openai import OpenAI
+from outline_index import OutlineIndex, load_index
+from outline_store import OutlineStore
 from pathlib import Path
+from rate_limit import RateLimiter, call_with_retries, estimate_tokens
+from story_context import bounded_story_messages
+import argparse
+import asyncio
+import json
+import os
 import random
+import tracing
+import uuid
 
 ### OpenAI/LLM functionality
 
-oai_api_key = open("openai_api_key.txt").read()
-oai_client = OpenAI(api_key=oai_api_key)
 # Define the GPT model to use
 GPT_MODEL = "gpt-3.5-turbo"# or "gpt-4-turbo"
+# API endpoint to send requests to; None means the OPENAI_BASE_URL
+# environment variable or the real OpenAI API. point this at a local
+# OpenAI-compatible server to run without spending anything
+oai_base_url = None
+
+# clients are created on first use, so the API key (and the openai
+# package) are only needed once we actually start generating
+oai_client = None
+oai_async_client = None
+
+# the API endpoint requests are sent to, or None for the real OpenAI API
+def api_endpoint():
+	return oai_base_url or os.environ.get("OPENAI_BASE_URL") or None
+
+def read_api_key():
+	return os.environ.get("OPENAI_API_KEY") or open("openai_api_key.txt").read().strip()
+
+# retries on 429/5xx responses and dropped connections
+max_retries = 6
+
+# the client leaves retries to `call_with_retries`, so they show up in the
+# metrics
+def get_client():
+	global oai_client
+	if oai_client is None:
+		from openai import OpenAI
+		oai_client = OpenAI(api_key=read_api_key(), base_url=oai_base_url, max_retries=0)
+	return oai_client
+
+# the async client leaves retries to the RateLimiter, which knows about
+# the rest of the in-flight requests
+def get_async_client():
+	global oai_async_client
+	if oai_async_client is None:
+		from openai import AsyncOpenAI
+		oai_async_client = AsyncOpenAI(api_key=read_api_key(), base_url=oai_base_url, max_retries=0)
+	return oai_async_client
+
+# optional persistent cache of completions (see completion_cache.py)
+completion_cache = None
+
+# look up a request in the completion cache, returning its key and the
+# cached response text (None on a miss, or if the cache isn't being read)
+def cached_completion(request, variant):
+	if completion_cache is None or completion_cache.mode == "off":
+		return None, None
+	key = request_key(request, variant, api_endpoint())
+	return key, completion_cache.get(key) if completion_cache.reads() else None
+
+def cache_completion(key, content):
+	if key is not None and completion_cache.writes():
+		completion_cache.put(key, content)
+
+# send a chat completion request and return the response text.
+# `variant` distinguishes otherwise-identical requests in the cache
+def complete(messages, variant=None):
+	request = {"messages": messages, "model": GPT_MODEL}
+	with tracing.span("completion", model=GPT_MODEL) as fields:
+		key, content = cached_completion(request, variant)
+		fields["cached"] = content is not None
+		if content is None:
+			completion = call_with_retries(lambda: get_client().chat.completions.create(**request), max_retries, fields)
+			tracing.add_usage(fields, completion)
+			content = completion.choices[0].message.content.strip()
+			cache_completion(key, content)
+	return content
+
+# async version of `complete`, subject to `limiter`'s concurrency cap,
+# rate limits and retries
+async def complete_async(messages, limiter, variant=None):
+	request = {"messages": messages, "model": GPT_MODEL}
+	with tracing.span("completion", model=GPT_MODEL) as fields:
+		key, content = cached_completion(request, variant)
+		fields["cached"] = content is not None
+		if content is None:
+			completion = await limiter.call(
+				lambda: get_async_client().chat.completions.create(**request),
+				messages,
+				fields
+			)
+			tracing.add_usage(fields, completion)
+			content = completion.choices[0].message.content.strip()
+			cache_completion(key, content)
+	return content
 
 # outline-based story generation: translate an ASP-generated outline
 # and a brief user input text into a sequence of LLM prompts
@@ -81,27 +173,36 @@ instructions_by_function = {
 }
 
 # try to control the length of each paragraph
-def get_random_sentence_count():
-    return random.randint(1, 7)
+def get_random_sentence_count(rng=random):
+    return rng.randint(1, 7)
+
+# tags for tracing the request for paragraph `n` of a story
+def paragraph_tags(n, outline=None):
+	return tracing.tags(purpose="paragraph", paragraph=n, function=outline[n] if outline else None)
+
+# the messages for the LLM call that brainstorms obstacles for a premise
+def obstacle_hint_messages(user_input_text):
+  obstacle_prompt_text = obstacle_prompt.replace("{{user_input_text}}", user_input_text)
+  return [{"role": "user", "content": obstacle_prompt_text}]
 
-def promptify_outline(outline, user_input_text):
+def needs_obstacle_hint(outline):
+  return "add_obstacle_towards_major_goal" in outline
+
+# `obstacle_hint` may be generated ahead of time (e.g. by an async caller);
+# if the outline needs one and none is given, it's generated here
+def promptify_outline(outline, user_input_text, obstacle_hint=None, rng=random):
   prompts = []
-  obstacle_hint = "" #get llm to generate examples first
+
+  if obstacle_hint is None and needs_obstacle_hint(outline):
+    # Generate the list of possible obstacles
+    with tracing.tags(purpose="obstacle_hint"):
+      obstacle_hint = complete(obstacle_hint_messages(user_input_text))
+    print("obstacle_hint:"+obstacle_hint)
 
   for i in range(len(outline)):
     is_first_paragraph = i == 0
     function = outline[i]
 
-    if function == "add_obstacle_towards_major_goal":
-      # Generate the list of possible obstacles
-      obstacle_prompt_text = obstacle_prompt.replace("{{user_input_text}}", user_input_text)
-      messages = [{"role": "user", "content": obstacle_prompt_text}]
-      completion = oai_client.chat.completions.create(
-        messages=messages, model=GPT_MODEL
-      )
-      obstacle_hint = completion.choices[0].message.content.strip()
-      print("obstacle_hint:"+obstacle_hint)
-
     instruction = instructions_by_function[function]
 
     if function == "add_obstacle_towards_major_goal":
@@ -109,7 +210,7 @@ def promptify_outline(outline, user_input_text):
       instruction = instruction.replace("{{obstacle_hint}}", obstacle_hint)
 
     # Generate a random sentence count for each paragraph
-    sentence_count = get_random_sentence_count()
+    sentence_count = get_random_sentence_count(rng)
     instruction += f" Use {sentence_count} sentences in the paragraph."
 
     prompt_template = init_prompt if is_first_paragraph else followup_prompt
@@ -134,14 +235,14 @@ naive_followup_prompt = """
 Write the next paragraph of the story. Remember the story is about: {{user_input_text}}.
 """.strip()
 
-def promptify_naively(num_paras, user_input_text):
+def promptify_naively(num_paras, user_input_text, rng=random):
   prompts = []
   for i in range(num_paras):
     is_first_paragraph = i == 0
     prompt = naive_init_prompt if is_first_paragraph else naive_followup_prompt
 
     # Generate a random sentence count for each paragraph
-    sentence_count = get_random_sentence_count()
+    sentence_count = get_random_sentence_count(rng)
     prompt += f" Use {sentence_count} sentences in the paragraph."
 
     if is_first_paragraph:
@@ -149,53 +250,714 @@ def promptify_naively(num_paras, user_input_text):
     prompts.append(prompt)
   return prompts
 
-# run a sequence of LLM prompts generated by one of the above approaches,
-# and extract the finished story from the LLM responses
-def storify_prompts(prompts):
-	messages = []
-	# adding a system prompt to make the language precise
-	messages.append({
-	  "role": "system",
-	  "content": "You're a fiction writer. You use simple and clear language that best conveys your meaning. You don't use big words just to sound impressive. You are also a master of the writing skill -  \"Show, don't tell.\" You use details, actions, and dialogues to show the characters and events. \n\n- Use simple, concrete words rather than complex, abstract, or vague language. For example, instead of saying \"The weather was unpleasant\", you could say \"Icy rain pelted my face and soaked through my thin jacket.\"\n\n- Pack a high density of information and detail into each sentence. Make every word count. \n\n- Show what's happening through description and action rather than simply telling or summarizing. For example, instead of \"John was angry\", write \"John slammed his fist on the table, his face reddening.\"\n\n- Engage the senses by describing how things look, feel, sound, smell, and taste. Transport the reader into the scene.\n\n- Avoid cliches, well-worn phrases, and generic descriptions. Use unexpected and vivid details to make your story unique."
-	})
-	for prompt in prompts:
-		# prompt the LLM for the next paragraph
+# adding a system prompt to make the language precise
+system_message = {
+  "role": "system",
+  "content": "You're a fiction writer. You use simple and clear language that best conveys your meaning. You don't use big words just to sound impressive. You are also a master of the writing skill -  \"Show, don't tell.\" You use details, actions, and dialogues to show the characters and events. \n\n- Use simple, concrete words rather than complex, abstract, or vague language. For example, instead of saying \"The weather was unpleasant\", you could say \"Icy rain pelted my face and soaked through my thin jacket.\"\n\n- Pack a high density of information and detail into each sentence. Make every word count. \n\n- Show what's happening through description and action rather than simply telling or summarizing. For example, instead of \"John was angry\", write \"John slammed his fist on the table, his face reddening.\"\n\n- Engage the senses by describing how things look, feel, sound, smell, and taste. Transport the reader into the scene.\n\n- Avoid cliches, well-worn phrases, and generic descriptions. Use unexpected and vivid details to make your story unique."
+}
+
+# how many of the most recent paragraphs to resend in full with each
+# request. None resends the whole story so far; otherwise older paragraphs
+# are replaced by a compact summary of the story's state (see
+# story_context.py), so input tokens stop growing quadratically
+context_paragraphs = None
+
+# build the messages that request the next paragraph of a story, given
+# its `prompts` and the `paragraphs` generated so far: every earlier prompt
+# and response is included as context for the next one
+def full_story_messages(prompts, paragraphs):
+	messages = [system_message]
+	for prompt, paragraph in zip(prompts, paragraphs):
 		messages.append({"role": "user", "content": prompt})
-		completion = oai_client.chat.completions.create(
-			messages=messages, model=GPT_MODEL
-		)
-		# append response message as context for future paragraphs
-		paragraph = completion.choices[0].message.content.strip()
 		messages.append({"role": "assistant", "content": paragraph})
+	messages.append({"role": "user", "content": prompts[len(paragraphs)]})
+	return messages
+
+# build the messages for the next paragraph of a story about `premise`,
+# honouring `context_paragraphs`. `outline` is only given for guided stories
+def story_messages(prompts, paragraphs, premise, outline=None):
+	if context_paragraphs is None:
+		return full_story_messages(prompts, paragraphs)
+	return bounded_story_messages(system_message, premise, prompts, paragraphs, context_paragraphs, outline)
+
+# estimated input tokens saved by bounded context for a finished story,
+# compared to resending the full history with every request
+def context_tokens_saved(prompts, paragraphs, premise, outline=None):
+	saved = 0
+	for n in range(len(paragraphs)):
+		full = estimate_tokens(full_story_messages(prompts, paragraphs[:n]))
+		saved += full - estimate_tokens(story_messages(prompts, paragraphs[:n], premise, outline))
+	return saved
+
+def report_context_savings(prompts, paragraphs, premise, outline=None):
+	if context_paragraphs is not None:
+		print(f"Bounded context saved ~{context_tokens_saved(prompts, paragraphs, premise, outline)} input tokens")
+
+# run a sequence of LLM prompts generated by one of the above approaches,
+# and extract the finished story from the LLM responses. a story that was
+# interrupted can be continued from the `paragraphs` it already has;
+# `on_paragraph` is called after each new paragraph is appended to them
+def storify_prompts(prompts, variant=None, premise=None, outline=None, paragraphs=None, on_paragraph=None):
+	paragraphs = [] if paragraphs is None else paragraphs
+	while len(paragraphs) < len(prompts):
+		# prompt the LLM for the next paragraph, with the paragraphs so far as context
+		with paragraph_tags(len(paragraphs), outline):
+			paragraph = complete(story_messages(prompts, paragraphs, premise, outline), variant)
+		paragraphs.append(paragraph)
 		#print(paragraph + "\n")
-	return [msg["content"] for msg in messages if msg["role"] == "assistant"]
-
-# load outlines from file so we can sample them as needed
-all_outlines = []
-with open("outlines.csv", "r") as outlines_file:
-	lines = outlines_file.read().splitlines()
-	all_outlines = [line.split(",") for line in lines if line != ""]
-
-# generate guided and unguided story batches for a given premise
-def gen_story_batches(premise, num_stories=10):
-	# make directories for story file output
-	timestamp = datetime.now().strftime("%Y%m%d%H%M")
-	output_dir = timestamp + "_" + premise
+		if on_paragraph is not None:
+			on_paragraph()
+	report_context_savings(prompts, paragraphs, premise, outline)
+	return paragraphs
+
+# async version of `storify_prompts`. paragraphs within one story still
+# run in order, since each depends on the ones before it
+async def storify_prompts_async(prompts, limiter, variant=None, premise=None, outline=None, paragraphs=None, on_paragraph=None):
+	paragraphs = [] if paragraphs is None else paragraphs
+	while len(paragraphs) < len(prompts):
+		messages = story_messages(prompts, paragraphs, premise, outline)
+		with paragraph_tags(len(paragraphs), outline):
+			paragraphs.append(await complete_async(messages, limiter, variant))
+		if on_paragraph is not None:
+			on_paragraph()
+	report_context_savings(prompts, paragraphs, premise, outline)
+	return paragraphs
+
+# load outlines from file so we can sample them as needed.
+# prefer the memory-mapped outline store written by gen_outlines.py,
+# falling back to the older outlines.csv format. if neither exists,
+# outlines are sampled on demand from plotgen.lp instead
+def load_outlines():
+	if Path("outlines.bin").exists():
+		return OutlineStore("outlines.bin")
+	if Path("outlines.csv").exists():
+		with open("outlines.csv", "r") as outlines_file:
+			lines = outlines_file.read().splitlines()
+			return [line.split(",") for line in lines if line != ""]
+	return None
+
+# both are loaded on first use; set either one beforehand to override it
+all_outlines = None
+outline_sampler = None
+
+# return `all_outlines`, loading them first if need be. returns None (and
+# sets up `outline_sampler`) when there are no outline files
+def get_all_outlines():
+	global all_outlines, outline_sampler
+	if all_outlines is None and outline_sampler is None:
+		all_outlines = load_outlines()
+		if all_outlines is None:
+			from outline_sampler import OutlineSampler
+			outline_sampler = OutlineSampler()
+	return all_outlines
+
+# pick a random outline for the next story
+def choose_outline(rng=random):
+	outlines = get_all_outlines()
+	if outlines is not None:
+		return rng.choice(outlines)
+	return outline_sampler.sample(rng=rng)[0]
+
+# how each premise's outlines are chosen: "random" draws every story's
+# outline independently, while "diverse" picks the whole batch at once so
+# that its outlines are as different from each other as possible
+OUTLINE_SELECTIONS = ("random", "diverse")
+outline_selection = "random"
+
+# feature index of `all_outlines` (see outline_index.py), loaded on first use
+outline_index = None
+# when outlines are sampled rather than loaded, diverse batches are picked
+# from this many sampled candidates per outline needed
+diverse_pool_factor = 20
+
+# pick `k` outlines that are as different from each other as possible
+def choose_diverse_outlines(k, rng=random):
+	global outline_index
+	outlines = get_all_outlines()
+	if outlines is None:
+		outlines = outline_sampler.sample(k * diverse_pool_factor, rng=rng)
+		index = OutlineIndex.from_outlines(outlines)
+	else:
+		if outline_index is None:
+			# outline lists only ever come from outlines.csv
+			outline_index = load_index(outlines, getattr(outlines, "path", "outlines.csv"))
+		index = outline_index
+	return [list(outlines[row]) for row in index.select(k, rng)]
+
+# diverse batches chosen so far, by (seed, premise, batch size)
+diverse_batches = {}
+
+# the outline for story `i` of a premise's batch of `num_stories`.
+# `rng` is the story's own random number generator
+def story_outline(seed, premise, i, num_stories, rng):
+	if outline_selection == "random":
+		return list(choose_outline(rng))
+	key = (seed, premise, num_stories)
+	if key not in diverse_batches:
+		diverse_batches[key] = choose_diverse_outlines(num_stories, random.Random(f"{seed}/{premise}/outlines"))
+	batch = diverse_batches[key]
+	# outline spaces smaller than the batch get reused
+	return batch[i % len(batch)]
+
+# each story gets its own random number generator, derived from the run's
+# `seed`, so that rerunning with the same seed rebuilds exactly the same
+# outlines and prompts (and so hits the completion cache) no matter what
+# order stories are generated in
+def story_rng(seed, premise, i):
+	return random.Random(f"{seed}/{premise}/{i}")
+
+# cache variant for one story's paragraph requests, so that identical
+# prompts in different stories still get independent completions
+def story_variant(seed, premise, i, kind):
+	return f"{seed}/{premise}/{i}/{kind}"
+
+# cache variant for a premise's obstacle hint. one hint is shared by every
+# story of the premise in a run, but runs with different seeds get their own
+def obstacle_hint_variant(seed, premise):
+	return f"{seed}/{premise}/obstacle_hint"
+
+def new_seed():
+	seed = random.randrange(2 ** 32)
+	print("Using seed:", seed)
+	return seed
+
+# make directories for a premise's story file output. stories from one run
+# share its `run_id`, which defaults to the current time
+def make_output_dir(premise, run_id=None):
+	if run_id is None:
+		run_id = new_run_id()
+	output_dir = run_id + "_" + premise
 	Path(f"./stories/{output_dir}/guided").mkdir(parents=True, exist_ok=True)
 	Path(f"./stories/{output_dir}/unguided").mkdir(parents=True, exist_ok=True)
 	print(f"Generating ./stories/{output_dir}...")
-	# generate stories into appropriate directories
-	for i in range(num_stories):
-		outline = random.choice(all_outlines)
-		print("Using outline:", outline)
-		guided_prompts = promptify_outline(outline, premise)
-		unguided_prompts = promptify_naively(len(outline), premise)
-		guided_story = storify_prompts(guided_prompts)
-		unguided_story = storify_prompts(unguided_prompts)
-		with open(f"./stories/{output_dir}/guided/{i}.txt", "w") as story_file:
-			story_file.write("\n".join(guided_story))
-		with open(f"./stories/{output_dir}/unguided/{i}.txt", "w") as story_file:
-			story_file.write("\n".join(unguided_story))
+	return output_dir
+
+def new_run_id():
+	return datetime.now().strftime("%Y%m%d%H%M%S")
+
+# run ids name a directory under ./runs and start each of the run's story
+# directories (`<run_id>_<premise>`), which eval.py splits at the first
+# underscore to recover the premise, so they can't contain either (or be
+# "." or "..")
+def valid_run_id(run_id):
+	return run_id.strip(".") != "" and not any(char in run_id for char in "_/\\")
+
+# write `data` as JSON to `path` without ever leaving a partial file behind.
+# with `exclusive`, an existing file is left alone instead of replaced, even
+# if another process is creating it at the same moment; returns whether
+# `path` was written
+def write_json_atomic(path, data, exclusive=False):
+	# a temporary name of its own, so concurrent writers never share one
+	tmp_path = Path(f"{path}.{uuid.uuid4().hex}.tmp")
+	with open(tmp_path, "w") as file:
+		json.dump(data, file)
+	if not exclusive:
+		os.replace(tmp_path, path)
+		return True
+	try:
+		# linking fails if `path` exists, unlike renaming over it
+		os.link(tmp_path, path)
+		return True
+	except FileExistsError:
+		return False
+	finally:
+		os.remove(tmp_path)
+
+def write_story(output_dir, kind, i, story):
+	path = Path(f"./stories/{output_dir}/{kind}/{i}.txt")
+	tmp_path = Path(f"{path}.tmp")
+	with open(tmp_path, "w") as story_file:
+		story_file.write("\n".join(story))
+	os.replace(tmp_path, path)
+
+### Resumable runs
+#
+# Every interactive run keeps a manifest in `./runs/<run_id>`: `run.json`
+# records the run's settings, and `stories/<p>_<i>.json` checkpoints story
+# `i` of the run's `p`th premise (its outline, obstacle hint, prompts and
+# every paragraph generated so far). Checkpoints are rewritten atomically
+# after each paragraph, so an interrupted run can be resumed from exactly
+# where it stopped. `hints/<p>.json` records the obstacle hint shared by
+# every story of the `p`th premise, so that shards and resumed runs all use
+# the same one. Runs can also be split into shards, each generating every
+# nth story, and the shards' manifests merged back together.
+
+runs_dir = Path("./runs")
+story_kinds = ("guided", "unguided")
+
+def run_path(run_id):
+	return runs_dir / run_id
+
+def load_run(run_id):
+	with open(run_path(run_id) / "run.json") as file:
+		return json.load(file)
+
+# the most recently started run, for resuming without naming one
+def latest_run_id():
+	manifests = list(runs_dir.glob("*/run.json"))
+	if not manifests:
+		raise ValueError(f"no runs to resume in {runs_dir}")
+	return max(manifests, key=lambda path: path.stat().st_mtime).parent.name
+
+# start a new run, or join an existing one when `shared` (e.g. as one of
+# several shards), in which case its settings must match
+def start_run(run_id, premises, num_stories=10, seed=None, shared=False):
+	if seed is None:
+		seed = new_seed()
+	run = {
+		"run_id": run_id, "premises": list(premises), "num_stories": num_stories,
+		"seed": seed, "model": GPT_MODEL, "context_paragraphs": context_paragraphs,
+		"outline_selection": outline_selection
+	}
+	(run_path(run_id) / "stories").mkdir(parents=True, exist_ok=True)
+	# shards may all start the run at once; exactly one of them creates it
+	if write_json_atomic(run_path(run_id) / "run.json", run, exclusive=True):
+		return run
+	if not shared:
+		raise ValueError(f"run {run_id} already exists; use --resume {run_id} to continue it")
+	if load_run(run_id) != run:
+		raise ValueError(f"run {run_id} was started with different settings")
+	return run
+
+# parse a shard spec like "2/4" into (2, 4); shards are numbered from 0
+def parse_shard(spec):
+	k, n = (int(part) for part in spec.split("/"))
+	if not 0 <= k < n:
+		raise ValueError(f"shard {spec} should be k/n with 0 <= k < n")
+	return k, n
+
+# the (premise number, story index) pairs of shard `k` of `n`: every nth
+# story of the run, so shards get a similar mix of premises and no story
+# belongs to more than one shard
+def shard_stories(run, shard=(0, 1)):
+	k, n = shard
+	stories = [(p, i) for p in range(len(run["premises"])) for i in range(run["num_stories"])]
+	return stories[k::n]
+
+def checkpoint_path(run, p, i):
+	return run_path(run["run_id"]) / "stories" / f"{p}_{i}.json"
+
+def load_checkpoint(run, p, i):
+	path = checkpoint_path(run, p, i)
+	if not path.exists():
+		return None
+	with open(path) as file:
+		return json.load(file)
+
+def save_checkpoint(run, p, story):
+	write_json_atomic(checkpoint_path(run, p, story["index"]), story)
+
+def output_dir(run, story):
+	return run["run_id"] + "_" + story["premise"]
+
+def story_finished(story):
+	return all(len(story[kind]["paragraphs"]) == len(story[kind]["prompts"]) for kind in story_kinds)
+
+def story_written(run, story):
+	return all(Path(f"./stories/{output_dir(run, story)}/{kind}/{story['index']}.txt").exists() for kind in story_kinds)
+
+def write_story_pair(run, story):
+	for kind in story_kinds:
+		write_story(output_dir(run, story), kind, story["index"], story[kind]["paragraphs"])
+
+# placeholder left in guided prompts until their obstacle hint is known
+obstacle_hint_placeholder = "{{obstacle_hint}}"
+
+# choose story `i`'s outline and build its prompts. the premise's obstacle
+# hint is left as a placeholder until it's generated (see `fill_obstacle_hint`)
+def plan_story(run, p, i):
+	premise = run["premises"][p]
+	rng = story_rng(run["seed"], premise, i)
+	outline = story_outline(run["seed"], premise, i, run["num_stories"], rng)
+	print("Using outline:", outline)
+	guided_prompts = promptify_outline(outline, premise, obstacle_hint_placeholder, rng)
+	unguided_prompts = promptify_naively(len(outline), premise, rng)
+	return {
+		"premise": premise, "index": i, "outline": outline, "needs_hint": needs_obstacle_hint(outline),
+		"guided": {"prompts": guided_prompts, "paragraphs": []},
+		"unguided": {"prompts": unguided_prompts, "paragraphs": []}
+	}
+
+def fill_obstacle_hint(story, obstacle_hint):
+	print("obstacle_hint:"+obstacle_hint)
+	story["guided"]["prompts"] = [prompt.replace(obstacle_hint_placeholder, obstacle_hint) for prompt in story["guided"]["prompts"]]
+	story["needs_hint"] = False
+
+# load story `i`'s checkpoint, planning (and checkpointing) it if it's new
+def resume_story(run, p, i):
+	story = load_checkpoint(run, p, i)
+	if story is None:
+		story = plan_story(run, p, i)
+		save_checkpoint(run, p, story)
+	return story
+
+# the stories of a shard that still need generating or writing out
+def pending_stories(run, shard=(0, 1)):
+	for premise in run["premises"]:
+		make_output_dir(premise, run["run_id"])
+	stories = shard_stories(run, shard)
+	pending = []
+	for p, i in stories:
+		story = load_checkpoint(run, p, i)
+		if story is None or not story_finished(story) or not story_written(run, story):
+			pending.append((p, i))
+	print(f"Run {run['run_id']}: {len(stories) - len(pending)} of {len(stories)} stories already done")
+	return pending
+
+def hint_path(run, p):
+	return run_path(run["run_id"]) / "hints" / f"{p}.json"
+
+# the obstacle hint recorded for the run's `p`th premise, if any
+def load_obstacle_hint(run, p):
+	path = hint_path(run, p)
+	if not path.exists():
+		return None
+	with open(path) as file:
+		return json.load(file)["obstacle_hint"]
+
+# record `obstacle_hint` for the run's `p`th premise and return it, unless
+# another shard recorded one first, in which case that one is returned
+def record_obstacle_hint(run, p, obstacle_hint):
+	hint_path(run, p).parent.mkdir(parents=True, exist_ok=True)
+	if write_json_atomic(hint_path(run, p), {"premise": run["premises"][p], "obstacle_hint": obstacle_hint}, exclusive=True):
+		return obstacle_hint
+	return load_obstacle_hint(run, p)
+
+# the obstacle hint shared by every story of the run's `p`th premise, read
+# from the run's manifest or else generated and recorded there. `hints`
+# holds the hints this process has used so far, by premise number
+def obstacle_hint(run, p, hints):
+	if p not in hints:
+		obstacle_hint = load_obstacle_hint(run, p)
+		if obstacle_hint is None:
+			premise = run["premises"][p]
+			# Generate the list of possible obstacles
+			with tracing.tags(story=None, story_kind="guided", purpose="obstacle_hint"):
+				obstacle_hint = complete(obstacle_hint_messages(premise), obstacle_hint_variant(run["seed"], premise))
+			obstacle_hint = record_obstacle_hint(run, p, obstacle_hint)
+		hints[p] = obstacle_hint
+	return hints[p]
+
+# generate (or finish) one guided/unguided story pair of a run
+def gen_story(run, p, i, hints=None):
+	story = resume_story(run, p, i)
+	premise = story["premise"]
+	with tracing.tags(premise=premise, story=i):
+		if story["needs_hint"]:
+			fill_obstacle_hint(story, obstacle_hint(run, p, {} if hints is None else hints))
+			save_checkpoint(run, p, story)
+		for kind in story_kinds:
+			with tracing.tags(story_kind=kind):
+				storify_prompts(
+					story[kind]["prompts"], story_variant(run["seed"], premise, i, kind), premise,
+					story["outline"] if kind == "guided" else None, story[kind]["paragraphs"],
+					lambda: save_checkpoint(run, p, story)
+				)
+	write_story_pair(run, story)
+
+# record the obstacle hint of every premise that any story of the run
+# needs, without generating any stories. shards started from a copy of the
+# run's manifest then all share these hints, even on separate machines
+def prefetch_obstacle_hints(run):
+	hints = {}
+	for p, i in shard_stories(run):
+		# stories are planned but not checkpointed, so they're left for the shards
+		story = load_checkpoint(run, p, i) or plan_story(run, p, i)
+		if story["needs_hint"]:
+			obstacle_hint(run, p, hints)
+	print(f"Run {run['run_id']}: recorded obstacle hints for {len(hints)} premises")
+	return hints
+
+# generate every unfinished story in a run's `shard`
+def gen_run(run, shard=(0, 1)):
+	hints = {}
+	for p, i in pending_stories(run, shard):
+		gen_story(run, p, i, hints)
+
+### Concurrent generation
+
+async def fetch_obstacle_hint_async(run, p, limiter):
+	obstacle_hint = load_obstacle_hint(run, p)
+	if obstacle_hint is None:
+		premise = run["premises"][p]
+		variant = obstacle_hint_variant(run["seed"], premise)
+		obstacle_hint = record_obstacle_hint(run, p, await complete_async(obstacle_hint_messages(premise), limiter, variant))
+	return obstacle_hint
+
+# async version of `obstacle_hint`. `hints` holds a task per premise, so
+# the hint is only requested once, however many of the premise's stories
+# need it at the same time
+async def obstacle_hint_async(run, p, limiter, hints):
+	if p not in hints:
+		# tasks copy the current tracing tags when they're created
+		with tracing.tags(story=None, story_kind="guided", purpose="obstacle_hint"):
+			hints[p] = asyncio.create_task(fetch_obstacle_hint_async(run, p, limiter))
+	return await hints[p]
+
+# async version of `gen_story`: the two stories of the pair are generated
+# concurrently, and written to disk as soon as both are done
+async def gen_story_async(run, p, i, limiter, hints=None):
+	story = resume_story(run, p, i)
+	premise = story["premise"]
+	with tracing.tags(premise=premise, story=i):
+		if story["needs_hint"]:
+			fill_obstacle_hint(story, await obstacle_hint_async(run, p, limiter, {} if hints is None else hints))
+			save_checkpoint(run, p, story)
+		tasks = []
+		for kind in story_kinds:
+			# tasks copy the current tracing tags when they're created
+			with tracing.tags(story_kind=kind):
+				tasks.append(asyncio.create_task(storify_prompts_async(
+					story[kind]["prompts"], limiter, story_variant(run["seed"], premise, i, kind), premise,
+					story["outline"] if kind == "guided" else None, story[kind]["paragraphs"],
+					lambda: save_checkpoint(run, p, story)
+				)))
+		await asyncio.gather(*tasks)
+	write_story_pair(run, story)
+
+# async version of `gen_run`: every unfinished story in the shard is
+# generated concurrently, sharing `limiter`
+async def gen_run_async(run, limiter, shard=(0, 1)):
+	hints = {}
+	await asyncio.gather(*[gen_story_async(run, p, i, limiter, hints) for p, i in pending_stories(run, shard)])
+
+### Merging shards
+
+def paragraph_count(story):
+	return sum(len(story[kind]["paragraphs"]) for kind in story_kinds)
+
+# merge the manifests of run `run_id` from other working directories (e.g.
+# copied back from the machines that ran its shards) into this one, keeping
+# whichever checkpoint of each story is furthest along, and write out every
+# finished story. merging the same directories again is harmless
+def merge_run(run_id, source_dirs):
+	for source_dir in source_dirs:
+		source = Path(source_dir) / "runs" / run_id
+		if source.resolve() == run_path(run_id).resolve():
+			continue
+		with open(source / "run.json") as file:
+			settings = json.load(file)
+		(run_path(run_id) / "stories").mkdir(parents=True, exist_ok=True)
+		if not write_json_atomic(run_path(run_id) / "run.json", settings, exclusive=True):
+			if load_run(run_id) != settings:
+				raise ValueError(f"{source} was started with different settings")
+		merged = 0
+		for path in (source / "stories").glob("*.json"):
+			with open(path) as file:
+				story = json.load(file)
+			target = run_path(run_id) / "stories" / path.name
+			if target.exists():
+				with open(target) as file:
+					if paragraph_count(json.load(file)) >= paragraph_count(story):
+						continue
+			write_json_atomic(target, story)
+			merged += 1
+		print(f"Merged {merged} checkpoints from {source}")
+		for path in (source / "hints").glob("*.json"):
+			with open(path) as file:
+				hint = json.load(file)
+			target = run_path(run_id) / "hints" / path.name
+			target.parent.mkdir(parents=True, exist_ok=True)
+			if not write_json_atomic(target, hint, exclusive=True):
+				with open(target) as file:
+					if json.load(file) != hint:
+						print(f"Warning: {source} used a different obstacle hint for premise {hint['premise']!r} (see --hints-only)")
+	run = load_run(run_id)
+	for premise in run["premises"]:
+		make_output_dir(premise, run_id)
+	unfinished = 0
+	for p, i in shard_stories(run):
+		story = load_checkpoint(run, p, i)
+		if story is not None and story_finished(story):
+			write_story_pair(run, story)
+		else:
+			unfinished += 1
+	if unfinished:
+		print(f"{unfinished} stories unfinished; finish them with --resume {run_id}")
+	return unfinished
+
+### Wavefront batch generation
+#
+# For large runs, paragraphs can be generated through the OpenAI batch API
+# instead of interactively: every story in the run advances by one paragraph
+# per "wave". Each wave is exported as a JSONL file of batch requests; once
+# the batch's results file has been downloaded and ingested, the responses
+# are appended to their stories and the next wave can be exported. All run
+# state lives in `<run_dir>/state.json`, which is rewritten atomically after
+# every ingest, so a run can be picked up again at any point.
+
+def load_wave_state(run_dir):
+	with open(Path(run_dir) / "state.json") as file:
+		return json.load(file)
+
+# set up a new wavefront run in `run_dir`, choosing outlines and building
+# prompts for every story up front (in the same order as an interactive
+# run, so the same seed gives the same prompts)
+def init_wave_run(run_dir, premises, num_stories=10, seed=None):
+	if seed is None:
+		seed = new_seed()
+	Path(run_dir).mkdir(parents=True, exist_ok=True)
+	state = {
+		"seed": seed, "model": GPT_MODEL, "context_paragraphs": context_paragraphs,
+		"outline_selection": outline_selection, "wave": 0, "pending": None, "premises": [], "stories": []
+	}
+	for premise in premises:
+		state["premises"].append({"premise": premise, "output_dir": make_output_dir(premise), "obstacle_hint": None})
+		for i in range(num_stories):
+			rng = story_rng(seed, premise, i)
+			outline = story_outline(seed, premise, i, num_stories, rng)
+			guided_prompts = promptify_outline(outline, premise, obstacle_hint_placeholder, rng)
+			unguided_prompts = promptify_naively(len(outline), premise, rng)
+			for kind, prompts in (("guided", guided_prompts), ("unguided", unguided_prompts)):
+				state["stories"].append({
+					"premise": premise, "index": i, "kind": kind, "outline": outline, "prompts": prompts,
+					"needs_hint": kind == "guided" and needs_obstacle_hint(outline), "paragraphs": []
+				})
+	write_json_atomic(Path(run_dir) / "state.json", state)
+	return state
+
+def wave_story_messages(story):
+	outline = story["outline"] if story["kind"] == "guided" else None
+	return story_messages(story["prompts"], story["paragraphs"], story["premise"], outline)
+
+# whether the next paragraph of a wave run's story can be requested yet.
+# stories that still wait for their premise's obstacle hint can go ahead
+# until they reach the paragraph that uses it
+def wave_story_ready(story):
+	if len(story["paragraphs"]) >= len(story["prompts"]):
+		return False
+	return obstacle_hint_placeholder not in story["prompts"][len(story["paragraphs"])]
+
+# batch request ids name the wave they belong to, e.g. "w003-story-12" for
+# the next paragraph of story 12 in wave 3, or "w000-hint-1" for premise 1's
+# obstacle hint, so results can't be ingested into the wrong wave
+def wave_custom_id(wave, kind, n):
+	return f"w{wave:03d}-{kind}-{n}"
+
+def parse_custom_id(custom_id):
+	wave, kind, n = custom_id.split("-")
+	return int(wave.lstrip("w")), kind, int(n)
+
+def wave_request(custom_id, messages, model):
+	return {
+		"custom_id": custom_id,
+		"method": "POST",
+		"url": "/v1/chat/completions",
+		"body": {"model": model, "messages": messages}
+	}
+
+# write the next wave of batch requests for a run and return its path, or
+# None if every story is finished. each wave contains the next paragraph of
+# every unfinished story, plus obstacle hints for premises that still need
+# one, which are requested alongside the first wave's paragraphs
+def export_wave(run_dir):
+	state = load_wave_state(run_dir)
+	if state["pending"]:
+		raise ValueError(f"{state['pending']} hasn't been ingested yet")
+	requests = []
+	for n, info in enumerate(state["premises"]):
+		waiting = any(story["premise"] == info["premise"] and story["needs_hint"] for story in state["stories"])
+		if waiting and info["obstacle_hint"] is None:
+			custom_id = wave_custom_id(state["wave"], "hint", n)
+			requests.append(wave_request(custom_id, obstacle_hint_messages(info["premise"]), state["model"]))
+	for n, story in enumerate(state["stories"]):
+		if wave_story_ready(story):
+			messages = wave_story_messages(story)
+			requests.append(wave_request(wave_custom_id(state["wave"], "story", n), messages, state["model"]))
+	if not requests:
+		return None
+	wave_path = Path(run_dir) / f"wave_{state['wave']:03d}.jsonl"
+	with open(wave_path, "w") as wave_file:
+		for request in requests:
+			wave_file.write(json.dumps(request) + "\n")
+	state["pending"] = wave_path.name
+	write_json_atomic(Path(run_dir) / "state.json", state)
+	print(f"Wrote {len(requests)} requests to {wave_path}")
+	return wave_path
+
+# ingest a batch results file for the run's pending wave. failed requests
+# are simply left unanswered, so they're retried as part of the next wave.
+# finished stories are written to their usual place under ./stories
+def ingest_wave(run_dir, results_path):
+	state = load_wave_state(run_dir)
+	if state["pending"] is None:
+		raise ValueError(f"no wave is pending in {run_dir}; export one before ingesting its results")
+	with open(results_path) as results_file:
+		results = [json.loads(line) for line in results_file if line.strip()]
+	# check the whole file before changing anything, so that results for
+	# another wave (or the same file twice) can't be appended to the stories
+	for result in results:
+		wave = parse_custom_id(result["custom_id"])[0]
+		if wave != state["wave"]:
+			raise ValueError(f"{results_path} has results for wave {wave}, but wave {state['wave']} ({state['pending']}) is pending")
+	failed = 0
+	ingested = set()
+	for result in results:
+		response = result.get("response") or {}
+		if result.get("error") or response.get("status_code") != 200:
+			failed += 1
+			continue
+		if result["custom_id"] in ingested:
+			continue
+		ingested.add(result["custom_id"])
+		content = response["body"]["choices"][0]["message"]["content"].strip()
+		_, kind, n = parse_custom_id(result["custom_id"])
+		if kind == "hint":
+			with tracing.tags(premise=state["premises"][n]["premise"], purpose="obstacle_hint"):
+				record_wave_completion(state, response)
+			ingest_obstacle_hint(state, n, content)
+		else:
+			story = state["stories"][n]
+			outline = story["outline"] if story["kind"] == "guided" else None
+			with tracing.tags(premise=story["premise"], story=story["index"], story_kind=story["kind"]):
+				with paragraph_tags(len(story["paragraphs"]), outline):
+					record_wave_completion(state, response)
+			ingest_paragraph(state, n, content)
+	state["pending"] = None
+	state["wave"] += 1
+	write_json_atomic(Path(run_dir) / "state.json", state)
+	remaining = sum(1 for story in state["stories"] if len(story["paragraphs"]) < len(story["prompts"]))
+	print(f"Ingested {results_path} ({failed} failed); {remaining} stories unfinished")
+	return remaining
+
+# record a batch response's token usage in the metrics file
+def record_wave_completion(state, response):
+	usage = response["body"].get("usage") or {}
+	tracing.record(
+		"completion", model=state["model"], batch=True, wave=state["wave"],
+		prompt_tokens=usage.get("prompt_tokens", 0), completion_tokens=usage.get("completion_tokens", 0)
+	)
+
+# record a batch response in the completion cache exactly as if it had
+# come from an interactive run with the same seed
+def cache_wave_completion(state, messages, variant, content):
+	if completion_cache is not None and completion_cache.writes():
+		request = {"messages": messages, "model": state["model"]}
+		completion_cache.put(request_key(request, variant), content)
+
+def ingest_obstacle_hint(state, n, obstacle_hint):
+	info = state["premises"][n]
+	info["obstacle_hint"] = obstacle_hint
+	variant = obstacle_hint_variant(state["seed"], info["premise"])
+	cache_wave_completion(state, obstacle_hint_messages(info["premise"]), variant, obstacle_hint)
+	print("obstacle_hint:"+obstacle_hint)
+	for story in state["stories"]:
+		if story["premise"] == info["premise"] and story["needs_hint"]:
+			story["prompts"] = [prompt.replace(obstacle_hint_placeholder, obstacle_hint) for prompt in story["prompts"]]
+			story["needs_hint"] = False
+
+def ingest_paragraph(state, n, paragraph):
+	story = state["stories"][n]
+	if len(story["paragraphs"]) >= len(story["prompts"]):
+		return
+	variant = story_variant(state["seed"], story["premise"], story["index"], story["kind"])
+	cache_wave_completion(state, wave_story_messages(story), variant, paragraph)
+	story["paragraphs"].append(paragraph)
+	if len(story["paragraphs"]) == len(story["prompts"]):
+		info = next(info for info in state["premises"] if info["premise"] == story["premise"])
+		write_story(info["output_dir"], story["kind"], story["index"], story["paragraphs"])
+		outline = story["outline"] if story["kind"] == "guided" else None
+		report_context_savings(story["prompts"], story["paragraphs"], story["premise"], outline)
 
 # define test set of premises
 premise_prompts = [
@@ -207,6 +969,84 @@ premise_prompts = [
   "starships shaped like organs"
 ]
 
-# generate a 10-story batch for each test premise (takes a while)
-for premise in premise_prompts:
-  gen_story_batches(premise)
+def main(argv=None, prog=None):
+	global oai_base_url, context_paragraphs, outline_selection, completion_cache, max_retries
+	parser = argparse.ArgumentParser(prog=prog, description="Generate guided and unguided story batches for each premise.")
+	parser.add_argument("--premise", action="append", help="premise to generate for (default: the built-in test set)")
+	parser.add_argument("--num-stories", type=int, default=10, help="stories per batch")
+	parser.add_argument("--concurrency", type=int, default=1, help="max in-flight API requests; above 1, stories are generated concurrently")
+	parser.add_argument("--rpm", type=int, help="requests-per-minute limit for concurrent generation")
+	parser.add_argument("--tpm", type=int, help="tokens-per-minute limit for concurrent generation")
+	parser.add_argument("--max-retries", type=int, default=6, help="retries on 429/5xx responses")
+	parser.add_argument("--base-url", help="OpenAI-compatible API endpoint (e.g. a local mock server)")
+	parser.add_argument("--seed", type=int, help="random seed; rerunning with the same seed rebuilds the same outlines and prompts")
+	parser.add_argument("--cache", choices=CACHE_MODES, default="read-through", help="how to use the completion cache")
+	parser.add_argument("--cache-path", default="completion_cache.sqlite", help="completion cache file")
+	parser.add_argument("--cache-max-mb", type=int, default=512, help="evict least recently used completions beyond this size")
+	parser.add_argument("--metrics", help="append a JSONL record of every completion call to this file")
+	parser.add_argument("--context-paragraphs", type=int, metavar="K", help="resend only the last K paragraphs in full, summarizing older ones")
+	parser.add_argument("--wavefront", metavar="RUN_DIR", help="generate through batch files in RUN_DIR instead of interactively: starts the run if needed and exports the next wave")
+	parser.add_argument("--ingest", metavar="RESULTS", help="with --wavefront, ingest a batch results file for the pending wave before exporting the next one")
+	parser.add_argument("--select", choices=OUTLINE_SELECTIONS, default="random", help="pick each story's outline independently at random, or each batch's outlines to be as diverse as possible")
+	parser.add_argument("--run-id", help="name of a new run (default: the current time), or of the run to --merge")
+	parser.add_argument("--resume", nargs="?", const="latest", metavar="RUN_ID", help="continue an interrupted run (default: the most recent one) from its last checkpoint")
+	parser.add_argument("--shard", type=parse_shard, metavar="K/N", help="only generate every Nth story of the run, starting from story K (0-based); needs --run-id and --seed")
+	parser.add_argument("--hints-only", action="store_true", help="start the run and record its premises' obstacle hints without generating stories, so shards on other machines can share them; needs --run-id and --seed")
+	parser.add_argument("--merge", nargs="+", metavar="WORKER_DIR", help="merge the --run-id run's checkpoints from these worker directories into this one and write out its finished stories")
+	args = parser.parse_args(argv)
+	if args.shard and not args.resume and (args.run_id is None or args.seed is None):
+		parser.error("--shard needs --run-id and --seed, so that every shard plans the same run")
+	if args.run_id is not None and not valid_run_id(args.run_id):
+		parser.error(f"--run-id {args.run_id!r} can't contain '_', '/' or '\\', or be empty, '.' or '..'")
+	if args.hints_only and (args.run_id is None or args.seed is None):
+		parser.error("--hints-only needs --run-id and --seed, so that shards can join the run")
+	if args.merge and args.run_id is None:
+		parser.error("--merge needs --run-id")
+	oai_base_url = args.base_url
+	max_retries = args.max_retries
+	if args.metrics:
+		tracing.enable(args.metrics)
+	context_paragraphs = args.context_paragraphs
+	outline_selection = args.select
+	premises = args.premise or premise_prompts
+	if args.cache != "off":
+		completion_cache = CompletionCache(args.cache_path, args.cache, args.cache_max_mb * 1024 * 1024)
+
+	if args.merge:
+		merge_run(args.run_id, args.merge)
+	elif args.wavefront:
+		if not (Path(args.wavefront) / "state.json").exists():
+			init_wave_run(args.wavefront, premises, args.num_stories, args.seed)
+		# every wave of a run must be built with the same context settings
+		context_paragraphs = load_wave_state(args.wavefront)["context_paragraphs"]
+		if args.ingest:
+			ingest_wave(args.wavefront, args.ingest)
+		if export_wave(args.wavefront) is None:
+			print("All stories finished")
+	else:
+		if args.resume:
+			run = load_run(latest_run_id() if args.resume == "latest" else args.resume)
+			if run["model"] != GPT_MODEL:
+				raise ValueError(f"run {run['run_id']} was started with model {run['model']}, not {GPT_MODEL}")
+			print(f"Resuming run {run['run_id']} (seed {run['seed']})")
+		else:
+			# generate a 10-story batch for each test premise (takes a while)
+			run_id = args.run_id or new_run_id()
+			run = start_run(run_id, premises, args.num_stories, args.seed, shared=args.shard is not None or args.hints_only)
+		# a run keeps the context and outline settings it was started with
+		context_paragraphs = run["context_paragraphs"]
+		outline_selection = run.get("outline_selection", "random")
+		shard = args.shard or (0, 1)
+		if args.hints_only:
+			prefetch_obstacle_hints(run)
+		elif args.concurrency > 1:
+			limiter = RateLimiter(args.concurrency, args.rpm, args.tpm, args.max_retries)
+			asyncio.run(gen_run_async(run, limiter, shard))
+		else:
+			gen_run(run, shard)
+
+	if completion_cache is not None:
+		print(f"Completion cache: {completion_cache.hits} hits, {completion_cache.misses} misses")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,131 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import json
+import random
+import threading
+import time
+
+# A minimal OpenAI-compatible chat completions server for benchmarks and
+# offline runs. Every request to /v1/chat/completions sleeps for a tunable
+# latency, then either fails with an injected error (429 or 5xx) or returns
+# a short made-up paragraph with plausible token usage.
+#
+#   python3 mock_server.py --port 8000 --latency 0.5 --error-rate 0.05
+#   python3 gen_stories.py --base-url http://127.0.0.1:8000/v1 --concurrency 16
+#
+# It can also answer batch API input files offline, e.g. a wavefront run's
+# waves (see gen_stories.py):
+#
+#   python3 mock_server.py --batch RUN_DIR/wave_000.jsonl results.jsonl
+
+words = (
+	"the cat pirate sailed through fog while the crew argued about gold and "
+	"an old map promised a hidden island where nobody had ever returned"
+).split()
+
+# a made-up chat completion response body for `request`, with plausible
+# token usage
+def mock_completion(request, completion_id, completion_words=60, rng=random):
+	content = " ".join(rng.choice(words) for _ in range(completion_words)).capitalize() + "."
+	prompt_tokens = sum(len(message["content"]) for message in request["messages"]) // 4
+	completion_tokens = len(content) // 4
+	return {
+		"id": f"chatcmpl-mock{completion_id}",
+		"object": "chat.completion",
+		"created": int(time.time()),
+		"model": request.get("model", "mock"),
+		"choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+		"usage": {
+			"prompt_tokens": prompt_tokens,
+			"completion_tokens": completion_tokens,
+			"total_tokens": prompt_tokens + completion_tokens,
+		},
+	}
+
+# answer a batch API input file offline, writing a results file in the batch
+# API's output format, so batch runs can be tested without the API.
+# `error_rate` of the requests fail with a 500
+def complete_batch(input_path, output_path, error_rate=0.0, completion_words=60, rng=random):
+	with open(input_path) as input_file, open(output_path, "w") as output_file:
+		for n, line in enumerate(line for line in input_file if line.strip()):
+			request = json.loads(line)
+			if rng.random() < error_rate:
+				response = {"status_code": 500, "request_id": f"mock{n}", "body": {"error": {"message": "injected error", "code": 500}}}
+			else:
+				response = {"status_code": 200, "request_id": f"mock{n}", "body": mock_completion(request["body"], n, completion_words, rng)}
+			output_file.write(json.dumps({"id": f"batch_req_mock{n}", "custom_id": request["custom_id"], "response": response, "error": None}) + "\n")
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+	def log_message(self, format, *args):
+		pass
+
+	def send_json(self, status, body, headers=None):
+		payload = json.dumps(body).encode("utf-8")
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(payload)))
+		for name, value in (headers or {}).items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(payload)
+
+	def do_POST(self):
+		if not self.path.rstrip("/").endswith("/chat/completions"):
+			self.send_json(404, {"error": {"message": f"unknown endpoint {self.path}"}})
+			return
+		request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+		server = self.server
+		time.sleep(max(0.0, random.gauss(server.latency, server.jitter)))
+		with server.lock:
+			server.requests += 1
+		if random.random() < server.error_rate:
+			status = random.choice([429, 500, 503])
+			with server.lock:
+				server.errors += 1
+			self.send_json(status, {"error": {"message": "injected error", "code": status}}, {"Retry-After": "0"})
+			return
+		self.send_json(200, mock_completion(request, server.requests, server.completion_words))
+
+class MockOpenAIServer(ThreadingHTTPServer):
+	daemon_threads = True
+
+	def __init__(self, port=0, latency=0.05, jitter=0.0, error_rate=0.0, completion_words=60):
+		super().__init__(("127.0.0.1", port), MockOpenAIHandler)
+		self.latency = latency
+		self.jitter = jitter
+		self.error_rate = error_rate
+		self.completion_words = completion_words
+		self.lock = threading.Lock()
+		self.requests = 0
+		self.errors = 0
+
+	@property
+	def base_url(self):
+		return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+	# serve requests from a background thread and return the server
+	def start(self):
+		threading.Thread(target=self.serve_forever, daemon=True).start()
+		return self
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+def main(argv=None, prog=None):
+	parser = argparse.ArgumentParser(prog=prog, description="Run a mock OpenAI-compatible chat completions server.")
+	parser.add_argument("--port", type=int, default=8000)
+	parser.add_argument("--latency", type=float, default=0.05, help="mean seconds per response")
+	parser.add_argument("--jitter", type=float, default=0.0, help="standard deviation of the latency")
+	parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail with 429/5xx")
+	parser.add_argument("--batch", nargs=2, metavar=("INPUT", "OUTPUT"), help="answer a batch API input file offline instead of serving")
+	args = parser.parse_args(argv)
+	if args.batch:
+		complete_batch(*args.batch, args.error_rate)
+		return
+	server = MockOpenAIServer(args.port, args.latency, args.jitter, args.error_rate)
+	print(f"Serving mock completions at {server.base_url}")
+	server.serve_forever()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,213 @@
+from outline_store import OutlineStore
+from pathlib import Path
+import argparse
+import hashlib
+import random
+import time
+import numpy as np
+
+# Feature index over a set of outlines, for picking batches of outlines that
+# are as different from each other as possible.
+#
+# Each outline is encoded as a compact bitset of binary features, packed
+# into uint64 words:
+# * which narrative function is at each scene position
+# * every personality and obstacle type it introduces
+# * every bigram of consecutive scene functions
+#
+# The distance between two outlines is the number of features only one of
+# them has. Outlines that only swap one personality for another are 2
+# apart, while outlines that tell their story in a different order are
+# much further apart. Words are stored one contiguous array per word, so
+# the distance from one outline to every other is a handful of vectorized
+# XORs and popcounts, and selection stays fast over millions of outlines.
+
+# feature ids: scene `position` performing `function` is
+# `position * 256 + function`; function:detail pairs and function bigrams
+# follow on after every possible position feature
+def feature_id_offsets(num_scenes):
+	pair_offset = 256 * num_scenes
+	bigram_offset = pair_offset + 256 * 256
+	return pair_offset, bigram_offset, bigram_offset + 256 * 256
+
+if hasattr(np, "bitwise_count"):
+	popcount = np.bitwise_count
+else:
+	byte_counts = np.array([bin(n).count("1") for n in range(256)], dtype=np.uint8)
+	def popcount(words):
+		return byte_counts[words.view(np.uint8)].reshape(*words.shape, 8).sum(axis=-1, dtype=np.uint8)
+
+# Yield the feature ids of every row of an outline store's code matrix, one
+# array per feature slot, with -1 where a row has no feature in that slot.
+def feature_columns(codes):
+	functions = codes[:, 0::2].astype(np.int64)
+	details = codes[:, 1::2].astype(np.int64)
+	pair_offset, bigram_offset, _ = feature_id_offsets(functions.shape[1])
+	for position in range(functions.shape[1]):
+		yield position * 256 + functions[:, position]
+		yield np.where(details[:, position] > 0, pair_offset + functions[:, position] * 256 + details[:, position], -1)
+	for position in range(functions.shape[1] - 1):
+		yield bigram_offset + functions[:, position] * 256 + functions[:, position + 1]
+
+# Encode a list of outlines (lists of "function" / "function:detail"
+# strings, all with the same number of scenes) as an outline store's
+# (rows, 2 * num_scenes) code matrix, returning the codes and symbol table.
+def encode_outlines(outlines):
+	labels = {}
+	ids = np.array([[labels.setdefault(scene, len(labels)) for scene in outline] for outline in outlines], dtype=np.int64)
+	symbols = [""]
+	symbol_codes = {"": 0}
+	def intern(name):
+		if name not in symbol_codes:
+			symbol_codes[name] = len(symbols)
+			symbols.append(name)
+		return symbol_codes[name]
+	label_codes = np.zeros((len(labels), 2), dtype=np.uint8)
+	for label, n in labels.items():
+		function, _, detail = label.partition(":")
+		label_codes[n] = intern(function), intern(detail)
+	return label_codes[ids].reshape(len(outlines), -1), symbols
+
+class OutlineIndex:
+	# `fingerprint` identifies the outlines file the index was built from
+	# (see `source_fingerprint`), if any
+	def __init__(self, features, vocabulary, num_scenes, fingerprint=None):
+		self.features = features
+		self.vocabulary = vocabulary
+		self.num_scenes = num_scenes
+		self.fingerprint = fingerprint
+		# an outline has at most 3 * num_scenes features
+		self.distance_type = np.uint8 if 6 * num_scenes < 256 else np.uint16
+
+	# Build the index from an outline store's code matrix.
+	@classmethod
+	def from_codes(cls, codes):
+		codes = np.asarray(codes, dtype=np.uint8)
+		num_ids = feature_id_offsets(codes.shape[1] // 2)[2]
+		seen = np.zeros(num_ids, dtype=bool)
+		for column in feature_columns(codes):
+			seen[column[column >= 0]] = True
+		vocabulary = np.flatnonzero(seen)
+		# bit number of each feature id that occurs
+		feature_bits = np.zeros(num_ids, dtype=np.int64)
+		feature_bits[vocabulary] = np.arange(len(vocabulary))
+		features = np.zeros(((len(vocabulary) + 63) // 64, len(codes)), dtype=np.uint64)
+		for column in feature_columns(codes):
+			# each column sets at most one bit per row, so there are no
+			# repeated (word, row) pairs in a single fancy-indexed update
+			rows = np.flatnonzero(column >= 0)
+			bits = feature_bits[column[rows]]
+			features[bits // 64, rows] |= np.left_shift(np.uint64(1), (bits % 64).astype(np.uint64))
+		return cls(features, vocabulary, codes.shape[1] // 2)
+
+	@classmethod
+	def from_store(cls, store):
+		return cls.from_codes(np.frombuffer(store.codes(), dtype=np.uint8).reshape(len(store), store.row_size))
+
+	@classmethod
+	def from_outlines(cls, outlines):
+		return cls.from_codes(encode_outlines(outlines)[0])
+
+	@classmethod
+	def load(cls, path):
+		with np.load(path) as arrays:
+			fingerprint = str(arrays["fingerprint"]) if "fingerprint" in arrays else None
+			return cls(arrays["features"], arrays["vocabulary"], int(arrays["num_scenes"]), fingerprint)
+
+	def save(self, path):
+		# np.savez appends .npz to names that don't already end with it
+		with open(path, "wb") as file:
+			np.savez(
+				file, features=self.features, vocabulary=self.vocabulary, num_scenes=self.num_scenes,
+				fingerprint=self.fingerprint or ""
+			)
+
+	def __len__(self):
+		return self.features.shape[1]
+
+	# distance from outline number `row` to every outline in the index
+	def distances(self, row):
+		distances = np.zeros(len(self), dtype=self.distance_type)
+		for words in self.features:
+			distances += popcount(words ^ words[row])
+		return distances
+
+	# Greedily pick `k` outlines that are as far apart as possible
+	# (farthest-point selection): start from a random outline, then keep
+	# adding whichever outline is furthest from its nearest already-chosen
+	# outline, breaking ties at random. Returns the chosen row numbers.
+	def select(self, k, rng=random):
+		k = min(k, len(self))
+		if k == 0:
+			return []
+		chosen = [rng.randrange(len(self))]
+		nearest = self.distances(chosen[0])
+		while len(chosen) < k:
+			furthest = np.flatnonzero(nearest == nearest.max())
+			chosen.append(int(furthest[rng.randrange(len(furthest))]))
+			np.minimum(nearest, self.distances(chosen[-1]), out=nearest)
+		return chosen
+
+	# the smallest distance between any two of the outlines in `rows`
+	def min_distance(self, rows):
+		chosen = OutlineIndex(self.features[:, rows], self.vocabulary, self.num_scenes)
+		return min((int(chosen.distances(n)[n + 1:].min()) for n in range(len(rows) - 1)), default=0)
+
+# where the index for the outlines in `source_path` is kept. every outlines
+# file gets its own (outlines.bin.idx.npz, outlines.csv.idx.npz...), since
+# the same outlines in a different order need a different index
+def index_path(source_path):
+	return Path(f"{source_path}.idx.npz")
+
+# hash of the contents of the outlines file at `source_path`, so that an
+# index is never used with outlines other than the ones it was built from
+def source_fingerprint(source_path):
+	digest = hashlib.blake2b(digest_size=16)
+	with open(source_path, "rb") as file:
+		for chunk in iter(lambda: file.read(1 << 20), b""):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+# build the index for `outlines` (an OutlineStore, or the list of outlines
+# read from `source_path`) and save it next to `source_path`
+def build_index(outlines, source_path):
+	if isinstance(outlines, OutlineStore):
+		index = OutlineIndex.from_store(outlines)
+	else:
+		index = OutlineIndex.from_outlines(outlines)
+	index.fingerprint = source_fingerprint(source_path)
+	index.save(index_path(source_path))
+	return index
+
+# Load the saved index for `outlines` (as for `build_index`), building it
+# first if it's missing or was built from a different outlines file.
+def load_index(outlines, source_path):
+	path = index_path(source_path)
+	if path.exists():
+		index = OutlineIndex.load(path)
+		if index.fingerprint == source_fingerprint(source_path) and len(index) == len(outlines):
+			return index
+	return build_index(outlines, source_path)
+
+def main(argv=None, prog=None):
+	parser = argparse.ArgumentParser(prog=prog, description="Build an outline feature index and pick maximally diverse outlines from it.")
+	parser.add_argument("--outlines", default="outlines.bin", help="outline store (or outlines.csv) to index")
+	parser.add_argument("-k", type=int, default=10, help="number of diverse outlines to pick")
+	parser.add_argument("--seed", type=int, help="random seed for the first pick")
+	args = parser.parse_args(argv)
+	if args.outlines.endswith(".csv"):
+		with open(args.outlines) as outlines_file:
+			outlines = [line.split(",") for line in outlines_file.read().splitlines() if line != ""]
+	else:
+		outlines = OutlineStore(args.outlines)
+	start = time.perf_counter()
+	index = load_index(outlines, args.outlines)
+	print(f"Indexed {len(index)} outlines ({len(index.vocabulary)} distinct features) in {time.perf_counter() - start:.2f}s")
+	start = time.perf_counter()
+	rows = index.select(args.k, random.Random(args.seed))
+	print(f"Selected {len(rows)} outlines in {time.perf_counter() - start:.2f}s (min pairwise distance {index.min_distance(rows)}):")
+	for row in rows:
+		print(",".join(outlines[row]))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,204 @@
+from clingo.control import Control
+from clingo.symbol import Function, Number
+from gen_outlines import clingo_args, outline_from_symbols, plotgen_path
+import argparse
+import random
+import worker
+
+# extra rules grounded alongside plotgen.lp so that per-request constraints
+# ("must include add_twist", "no cold characters") can be passed to the
+# solver as assumptions instead of requiring a new program to be grounded
+sampler_program = """
+outline_has(F) :- scene_performs_function(_,F).
+outline_has(P) :- scene_introduce_personality(_,P).
+outline_has(O) :- scene_define_obstacle_type(_,O).
+"""
+
+# translate a single scene label ("add_twist", "introduce_character:cold")
+# into the solver assumptions that pin scene number `scene` to it
+def scene_assumptions(scene, label):
+	function, _, detail = label.partition(":")
+	assumptions = [(Function("scene_performs_function", [Number(scene), Function(function)]), True)]
+	if detail:
+		predicate = "scene_introduce_personality" if function == "introduce_character" else "scene_define_obstacle_type"
+		assumptions.append((Function(predicate, [Number(scene), Function(detail)]), True))
+	return assumptions
+
+# Draws random outlines from plotgen.lp on demand, without enumerating the
+# whole answer-set space first. Each distinct `num_scenes` value is grounded
+# once and its multi-shot Control kept alive, so a sample costs a handful of
+# cheap solver calls rather than a full enumeration.
+#
+# Randomized decision heuristics alone are heavily biased towards whichever
+# atoms the solver happens to try first, and so is pinning each scene to a
+# label picked uniformly at random, since labels leading into small parts of
+# the outline space get picked as often as labels leading into large ones.
+# So by default each sample walks the scenes in order and pins each one to a
+# label picked with probability proportional to the number of outlines that
+# complete it, counted by enumerating under assumptions. Once few enough
+# outlines are left (`direct_limit`), one of them is picked directly by
+# enumerating up to a random position. Counts are capped at `count_cap`
+# (labels with more completions are weighted as if they had exactly that
+# many), which makes samples exactly uniform whenever no count reaches the
+# cap. Counts are cached per prefix of pinned scenes, so only the first
+# samples from a large space pay for counting its top levels.
+class OutlineSampler:
+	def __init__(self, program_path=plotgen_path, seed=None, rand_freq=1.0, pin_scenes=True, count_cap=100000, direct_limit=500):
+		self.program_path = program_path
+		self.rng = random.Random(seed)
+		self.rand_freq = rand_freq
+		self.pin_scenes = pin_scenes
+		self.count_cap = count_cap
+		self.direct_limit = direct_limit
+		self.controls = {}
+		self.scene_labels = {}
+		self.counts = {}
+
+	# return the grounded Control for `num_scenes` (None meaning the default
+	# from plotgen.lp), grounding it on first use
+	def control(self, num_scenes=None):
+		ctl = self.controls.get(num_scenes)
+		if ctl is None:
+			args = clingo_args(num_scenes=num_scenes)
+			args += ["--sign-def=rnd", f"--rand-freq={self.rand_freq}"]
+			ctl = Control(args)
+			ctl.configuration.solve.models = 1
+			ctl.load(str(self.program_path))
+			ctl.add("base", [], sampler_program)
+			ctl.ground()
+			self.controls[num_scenes] = ctl
+			self.scene_labels[num_scenes] = self.labels_by_scene(ctl)
+		return ctl
+
+	# list the candidate labels for every scene in the grounded program,
+	# e.g. {1: ["add_twist", "introduce_character:cold", ...], 2: [...]}
+	def labels_by_scene(self, ctl):
+		def atom_args(name):
+			return [atom.symbol.arguments for atom in ctl.symbolic_atoms.by_signature(name, 2)]
+		details = {}
+		for predicate, function in (("scene_introduce_personality", "introduce_character"), ("scene_define_obstacle_type", "add_obstacle")):
+			for scene, detail in atom_args(predicate):
+				details.setdefault((scene.number, function), []).append(detail.name)
+		labels = {}
+		for scene, function in atom_args("scene_performs_function"):
+			scene, function = scene.number, function.name
+			if (scene, function) in details:
+				labels.setdefault(scene, []).extend(f"{function}:{detail}" for detail in details[(scene, function)])
+			else:
+				labels.setdefault(scene, []).append(function)
+		return labels
+
+	# translate per-request constraints into solver assumptions.
+	# `require` and `forbid` name functions, personalities or obstacle types
+	# that must (or must not) appear anywhere in the outline; `scenes` pins
+	# individual scenes, e.g. {4: "add_twist", 1: "introduce_character:cold"}
+	def assumptions(self, ctl, require=(), forbid=(), scenes=None):
+		known = {atom.symbol.arguments[0].name for atom in ctl.symbolic_atoms.by_signature("outline_has", 1)}
+		assumptions = []
+		for names, value in ((require, True), (forbid, False)):
+			for name in names:
+				if name not in known:
+					raise ValueError(f"unknown outline element: {name}")
+				assumptions.append((Function("outline_has", [Function(name)]), value))
+		for scene, label in (scenes or {}).items():
+			assumptions += scene_assumptions(scene, label)
+		return assumptions
+
+	# the number of outlines satisfying `assumptions`, up to `count_cap`
+	def count(self, ctl, num_scenes, assumptions):
+		key = (num_scenes, tuple(assumptions))
+		if key not in self.counts:
+			models = 0
+			def on_model(model):
+				nonlocal models
+				models += 1
+			ctl.configuration.solve.models = self.count_cap
+			ctl.solve(assumptions=assumptions, on_model=on_model)
+			ctl.configuration.solve.models = 1
+			self.counts[key] = models
+		return self.counts[key]
+
+	# the outline found `n`th (from 0) when enumerating under `assumptions`
+	def nth_outline(self, ctl, assumptions, n):
+		found = []
+		def on_model(model):
+			if model.number == n + 1:
+				found.append(outline_from_symbols(model.symbols(shown=True)))
+		ctl.configuration.solve.models = n + 1
+		ctl.solve(assumptions=assumptions, on_model=on_model)
+		ctl.configuration.solve.models = 1
+		return found[0] if found else None
+
+	# draw an outline satisfying `assumptions` (near-)uniformly at random:
+	# pin each scene not already in `pinned` to a random label, weighted by
+	# how many outlines complete it given every scene pinned before it,
+	# until few enough outlines are left to pick one of them directly
+	def random_outline(self, ctl, num_scenes, labels, assumptions, pinned, rng):
+		assumptions = list(assumptions)
+		for scene in sorted(labels):
+			if self.count(ctl, num_scenes, assumptions) <= self.direct_limit:
+				break
+			if scene in pinned:
+				continue
+			candidates = [assumptions + scene_assumptions(scene, label) for label in labels[scene]]
+			assumptions = rng.choices(candidates, [self.count(ctl, num_scenes, candidate) for candidate in candidates])[0]
+		total = self.count(ctl, num_scenes, assumptions)
+		return self.nth_outline(ctl, assumptions, rng.randrange(total)) if total else None
+
+	# return up to `n` random outlines satisfying the given constraints
+	# (see `assumptions` above). with `unique` set, duplicate draws are
+	# retried a bounded number of times, so fewer than `n` outlines may be
+	# returned when the constrained space is very small. returns an empty
+	# list if the constraints are unsatisfiable. `rng` overrides the
+	# sampler's own random number generator for this call
+	def sample(self, n=1, require=(), forbid=(), scenes=None, num_scenes=None, unique=True, rng=None):
+		rng = rng or self.rng
+		ctl = self.control(num_scenes)
+		assumptions = self.assumptions(ctl, require, forbid, scenes)
+		if not ctl.solve(assumptions=assumptions).satisfiable:
+			return []
+		outlines = []
+		seen = set()
+		attempts = 0
+		while len(outlines) < n and attempts < n * 10:
+			attempts += 1
+			ctl.configuration.solver.seed = str(rng.randrange(2 ** 31))
+			if self.pin_scenes:
+				outline = self.random_outline(ctl, num_scenes, self.scene_labels[num_scenes], assumptions, scenes or {}, rng)
+			else:
+				found = []
+				ctl.solve(
+					assumptions=assumptions,
+					on_model=lambda model: found.append(outline_from_symbols(model.symbols(shown=True)))
+				)
+				outline = found[0] if found else None
+			if outline is None:
+				continue
+			key = ",".join(outline)
+			if unique and key in seen:
+				continue
+			seen.add(key)
+			outlines.append(outline)
+		return outlines
+
+def main(argv=None, prog=None):
+	parser = argparse.ArgumentParser(prog=prog, description="Sample random story outlines from plotgen.lp.")
+	parser.add_argument("-n", type=int, default=1, help="number of outlines to sample")
+	parser.add_argument("--require", action="append", default=[], help="function, personality or obstacle type that must appear")
+	parser.add_argument("--forbid", action="append", default=[], help="function, personality or obstacle type that must not appear")
+	parser.add_argument("--num-scenes", type=int, help="override the num_scenes constant in plotgen.lp")
+	parser.add_argument("--seed", type=int, help="random seed for reproducible samples")
+	parser.add_argument("--fast", action="store_true", help="skip per-scene pinning: faster, but far from uniform")
+	parser.add_argument("--count-cap", type=int, default=100000, help="cap on the completion counts that weight each scene's labels; sampling is exactly uniform below it")
+	parser.add_argument("--worker", nargs="?", const=worker.default_url, metavar="URL", help="sample from a running worker (see worker.py) instead of grounding plotgen.lp here")
+	args = parser.parse_args(argv)
+	if args.worker:
+		outlines = worker.sample(args.worker, args.n, args.require, args.forbid, num_scenes=args.num_scenes, seed=args.seed)
+	else:
+		sampler = OutlineSampler(seed=args.seed, pin_scenes=not args.fast, count_cap=args.count_cap)
+		outlines = sampler.sample(args.n, args.require, args.forbid, num_scenes=args.num_scenes)
+	for outline in outlines:
+		print(",".join(outline))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,133 @@
+import mmap
+import struct
+
+# Compact on-disk storage for enumerated story outlines.
+#
+# File layout: a fixed-size header, then one fixed-width row per outline,
+# then the symbol table. Each row holds two uint8 codes per scene: the
+# scene's narrative function and its personality/obstacle type (0 if the
+# function doesn't take one). The symbol table maps codes back to names and
+# is stored as newline-separated UTF-8, with code 0 reserved for "no symbol".
+
+MAGIC = b"SPLW"
+VERSION = 1
+# magic, version, num_scenes, num_rows, symbol table offset
+HEADER = struct.Struct("<4sHHQQ")
+MAX_SYMBOLS = 256
+
+# Given a row of per-scene `codes` and the store's `symbols` table, return
+# the outline in the same "function" / "function:detail" format used by
+# outlines.csv.
+def decode_outline(codes, symbols):
+	outline = []
+	for i in range(0, len(codes), 2):
+		function = symbols[codes[i]]
+		detail = codes[i + 1]
+		outline.append(f"{function}:{symbols[detail]}" if detail else function)
+	return outline
+
+# Streams outlines into a store file one row at a time, interning symbols
+# as it goes, so the full set of outlines never has to be held in memory.
+class OutlineWriter:
+	def __init__(self, path, num_scenes=None):
+		self.path = path
+		self.file = open(path, "wb")
+		self.num_scenes = num_scenes
+		self.num_rows = 0
+		self.symbols = [""]
+		self.codes = {"": 0}
+		self.file.write(HEADER.pack(MAGIC, VERSION, num_scenes or 0, 0, 0))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def intern(self, name):
+		code = self.codes.get(name)
+		if code is None:
+			if len(self.symbols) >= MAX_SYMBOLS:
+				raise ValueError(f"too many distinct outline symbols (max {MAX_SYMBOLS - 1})")
+			code = len(self.symbols)
+			self.symbols.append(name)
+			self.codes[name] = code
+		return code
+
+	# Append a single outline, given as a list of "function" or
+	# "function:detail" strings (one per scene).
+	def write(self, outline):
+		if self.num_scenes is None:
+			self.num_scenes = len(outline)
+		if len(outline) != self.num_scenes:
+			raise ValueError(f"expected {self.num_scenes} scenes, got {len(outline)}")
+		row = bytearray(2 * self.num_scenes)
+		for i, scene in enumerate(outline):
+			function, _, detail = scene.partition(":")
+			row[2 * i] = self.intern(function)
+			if detail:
+				row[2 * i + 1] = self.intern(detail)
+		self.file.write(row)
+		self.num_rows += 1
+
+	# Write the symbol table and finalize the header. Until this is called
+	# the file reports zero rows, so a crashed enumeration is never mistaken
+	# for a complete one.
+	def close(self):
+		if self.file.closed:
+			return
+		symbols_offset = self.file.tell()
+		self.file.write("\n".join(self.symbols).encode("utf-8"))
+		self.file.seek(0)
+		self.file.write(HEADER.pack(MAGIC, VERSION, self.num_scenes or 0, self.num_rows, symbols_offset))
+		self.file.close()
+
+# Read-only, memory-mapped view of an outline store. Supports len(), indexing
+# and iteration, so it can be passed anywhere a list of outlines is expected
+# (e.g. to `random.choice`) without loading every row into memory.
+class OutlineStore:
+	def __init__(self, path):
+		self.path = path
+		with open(path, "rb") as file:
+			self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, version, num_scenes, num_rows, symbols_offset = HEADER.unpack_from(self.buffer, 0)
+		if magic != MAGIC or version != VERSION:
+			raise ValueError(f"{path} is not a version {VERSION} outline store")
+		self.num_scenes = num_scenes
+		self.num_rows = num_rows
+		self.row_size = 2 * num_scenes
+		self.symbols = self.buffer[symbols_offset:].decode("utf-8").split("\n")
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def __len__(self):
+		return self.num_rows
+
+	def __getitem__(self, index):
+		return decode_outline(self.row(index), self.symbols)
+
+	def __iter__(self):
+		for i in range(self.num_rows):
+			yield self[i]
+
+	# Return the raw codes for the outline at `index` without decoding them.
+	def row(self, index):
+		if index < 0:
+			index += self.num_rows
+		if not 0 <= index < self.num_rows:
+			raise IndexError("outline index out of range")
+		start = HEADER.size + index * self.row_size
+		return self.buffer[start:start + self.row_size]
+
+	# Return a zero-copy view of every row's codes, suitable for
+	# `np.frombuffer(...).reshape(len(store), store.row_size)`.
+	def codes(self):
+		start = HEADER.size
+		return memoryview(self.buffer)[start:start + self.num_rows * self.row_size]
+
+	def close(self):
+		self.buffer.close()
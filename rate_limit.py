@@ -0,0 +1,117 @@
+import asyncio
+import random
+import time
+
+# A token bucket holding up to `per_minute` units that refills continuously.
+# `acquire` waits until enough units are available; `charge` lets callers
+# correct an up-front estimate once the true cost is known (so the balance
+# may briefly go negative after an underestimate).
+class TokenBucket:
+	def __init__(self, per_minute):
+		self.capacity = per_minute
+		self.rate = per_minute / 60
+		self.available = per_minute
+		self.updated = time.monotonic()
+		self.lock = asyncio.Lock()
+
+	def refill(self):
+		now = time.monotonic()
+		self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+		self.updated = now
+
+	async def acquire(self, amount=1):
+		# never wait for more than the bucket can ever hold
+		amount = min(amount, self.capacity)
+		async with self.lock:
+			self.refill()
+			while self.available < amount:
+				await asyncio.sleep((amount - self.available) / self.rate)
+				self.refill()
+			self.available -= amount
+
+	def charge(self, amount):
+		self.refill()
+		self.available -= amount
+
+# Rough token count for a list of chat messages (about four characters per
+# token), used to reserve tokens-per-minute budget before a request is sent.
+def estimate_tokens(messages):
+	return sum(len(message["content"]) for message in messages) // 4 + 4 * len(messages)
+
+# Decide whether a failed API call is worth retrying: rate limits (429),
+# server errors (5xx) and dropped connections are; anything else
+# (bad request, auth failure) is not.
+def is_retryable(error):
+	import openai
+	if isinstance(error, openai.APIStatusError):
+		return error.status_code == 429 or error.status_code >= 500
+	return isinstance(error, openai.APIConnectionError)
+
+# Seconds to wait before retry number `attempt` (starting at 0): the
+# server's Retry-After header if it sent one, otherwise exponential backoff
+# with full jitter.
+def backoff_delay(error, attempt, base=1.0, cap=60.0):
+	response = getattr(error, "response", None)
+	retry_after = response.headers.get("retry-after") if response is not None else None
+	if retry_after:
+		try:
+			return min(cap, float(retry_after))
+		except ValueError:
+			pass
+	return random.uniform(0, min(cap, base * 2 ** attempt))
+
+# Synchronous counterpart of `RateLimiter.call` for requests made one at a
+# time: call `make_request()`, retrying transient errors with backoff, and
+# fill in `stats` the same way (with no limits, "queue_wait" is always 0)
+def call_with_retries(make_request, max_retries=6, stats=None):
+	stats = {} if stats is None else stats
+	stats["queue_wait"] = 0.0
+	stats["retries"] = 0
+	for attempt in range(max_retries + 1):
+		try:
+			return make_request()
+		except Exception as error:
+			if attempt == max_retries or not is_retryable(error):
+				raise
+			stats["retries"] += 1
+			time.sleep(backoff_delay(error, attempt))
+
+# Bounds in-flight requests and requests/tokens per minute for a set of
+# concurrent API calls, retrying transient failures with backoff.
+class RateLimiter:
+	def __init__(self, concurrency=8, requests_per_minute=None, tokens_per_minute=None, max_retries=6, completion_tokens=400):
+		self.semaphore = asyncio.Semaphore(concurrency)
+		self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+		self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+		self.max_retries = max_retries
+		# tokens reserved for each response before its real length is known
+		self.completion_tokens = completion_tokens
+
+	# await `make_request()` (a zero-argument coroutine function returning a
+	# chat completion) once rate limits allow, retrying transient errors.
+	# if given, `stats` is filled in with the total time spent waiting on the
+	# limits ("queue_wait") and the number of "retries"
+	async def call(self, make_request, messages, stats=None):
+		stats = {} if stats is None else stats
+		stats["queue_wait"] = 0.0
+		stats["retries"] = 0
+		reserved = estimate_tokens(messages) + self.completion_tokens
+		for attempt in range(self.max_retries + 1):
+			waiting_since = time.monotonic()
+			if self.requests:
+				await self.requests.acquire()
+			if self.tokens:
+				await self.tokens.acquire(reserved)
+			try:
+				async with self.semaphore:
+					stats["queue_wait"] += time.monotonic() - waiting_since
+					completion = await make_request()
+			except Exception as error:
+				if attempt == self.max_retries or not is_retryable(error):
+					raise
+				stats["retries"] += 1
+				await asyncio.sleep(backoff_delay(error, attempt))
+				continue
+			if self.tokens and completion.usage:
+				self.tokens.charge(completion.usage.total_tokens - reserved)
+			return completion
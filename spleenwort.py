@@ -0,0 +1,45 @@
+import argparse
+import importlib
+import sys
+
+# Single command line entry point for the whole pipeline:
+#
+#   python3 spleenwort.py outlines --threads 4
+#   python3 spleenwort.py stories --concurrency 16
+#   python3 spleenwort.py eval
+#
+# Each command is implemented by the `main` function of one of the
+# pipeline's modules, which is only imported once its command has been
+# chosen, so a command never pays for another command's dependencies
+# (e.g. `stories` never imports torch, and `eval` never imports openai).
+# `python3 spleenwort.py COMMAND --help` lists a command's options.
+
+# command name -> (module, leading arguments for its `main`, description)
+commands = {
+	"outlines": ("gen_outlines", [], "enumerate every outline allowed by plotgen.lp"),
+	"index": ("outline_index", [], "index outlines and pick a maximally diverse batch"),
+	"sample": ("outline_sampler", [], "sample random outlines from plotgen.lp on demand"),
+	"stories": ("gen_stories", [], "generate guided and unguided story batches"),
+	"eval": ("eval", [], "evaluate the homogeneity of generated story batches"),
+	"report": ("tracing", ["report"], "summarize a metrics file"),
+	"worker": ("worker", [], "serve sampling and evaluation from a warm local worker"),
+	"benchmark": ("benchmark", [], "benchmark the outline, story and eval stages"),
+	"mock-server": ("mock_server", [], "run a mock OpenAI-compatible server"),
+}
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(
+		prog="spleenwort",
+		description="ASP-guided LLM story generation.",
+		epilog="commands:\n" + "\n".join(f"  {name:<12} {description}" for name, (_, _, description) in commands.items()),
+		formatter_class=argparse.RawDescriptionHelpFormatter
+	)
+	parser.add_argument("command", choices=commands, metavar="command")
+	parser.add_argument("args", nargs=argparse.REMAINDER, help="options for the command (see COMMAND --help)")
+	args = parser.parse_args(argv)
+	module_name, leading_args, _ = commands[args.command]
+	module = importlib.import_module(module_name)
+	module.main(leading_args + args.args, prog=f"spleenwort {args.command}")
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,100 @@
+import re
+
+# Bounded-context prompting: rather than resending every earlier prompt and
+# paragraph with each request, keep the full text of only the last few
+# paragraphs and replace everything older with a compact summary of the
+# story's state. For guided stories the state is derived from the outline
+# itself (who has been introduced, which obstacles are active); for any
+# story it also includes the opening sentence of each dropped paragraph.
+
+# stands in for the instruction of a paragraph that has already been written,
+# so long instructions aren't resent once they've been fulfilled
+fulfilled_prompt = "Write the next paragraph of the story."
+
+personality_descriptions = {
+	"cold": "cold and solitary",
+	"sunny": "optimistic and brave",
+	"clumsy": "innocent and naive",
+	"smart": "strategic and wise",
+	"mysterious": "mysterious, with hidden motives",
+	"quirky": "quirky and eccentric",
+}
+
+obstacle_descriptions = {
+	"betrayal": "a betrayal by someone trusted",
+	"supernatural": "a supernatural force",
+	"forbidden_love": "a forbidden love",
+	"opposition": "opposition from others, society or nature",
+	"guilt": "guilt over a past mistake",
+}
+
+event_descriptions = {
+	"add_conflict_between_characters": "two characters came into conflict",
+	"add_bonding_between_characters": "two characters grew closer",
+	"add_breakthrough": "the protagonist made a breakthrough towards their goal",
+	"add_twist": "a plot twist changed the situation",
+	"describe_setting": "the setting was described",
+}
+
+def first_sentence(paragraph):
+	match = re.match(r"(.+?[.!?][\"')\]]*)(\s|$)", paragraph.strip(), re.DOTALL)
+	return match.group(1) if match else paragraph.strip()
+
+# The running state of a story, updated one paragraph at a time.
+class StoryState:
+	def __init__(self):
+		self.characters = []
+		self.obstacles = []
+		self.events = []
+		self.earlier = []
+
+	# record paragraph `paragraph`, written for outline `function` (None for
+	# unguided stories). `dropped` says whether the paragraph's full text is
+	# no longer in context, in which case its opening is kept as a summary
+	def update(self, function, paragraph, dropped):
+		function, _, detail = (function or "").partition(":")
+		if function == "introduce_character":
+			personality = personality_descriptions.get(detail)
+			self.characters.append(f"a {personality} character" if personality else "a new character")
+		elif function == "introduce_rival_character":
+			self.characters.append("an enemy of an earlier character")
+		elif function == "add_obstacle":
+			self.obstacles.append(obstacle_descriptions.get(detail, "a new obstacle"))
+		elif function == "add_obstacle_towards_major_goal":
+			self.obstacles.append("an obstacle blocking the protagonist's major goal")
+		elif function == "level_up_obstacle" and self.obstacles:
+			self.obstacles[-1] += " (now intensified)"
+		elif function in event_descriptions:
+			self.events.append(event_descriptions[function])
+		if dropped:
+			self.earlier.append(first_sentence(paragraph))
+
+	def describe(self):
+		lines = []
+		if self.earlier:
+			lines.append("Earlier paragraphs began:\n" + "\n".join(f"- {sentence}" for sentence in self.earlier))
+		if self.characters:
+			lines.append("Characters introduced so far: " + "; ".join(self.characters) + ".")
+		if self.obstacles:
+			lines.append("Active obstacles: " + "; ".join(self.obstacles) + ".")
+		if self.events:
+			lines.append("Key events so far: " + "; ".join(self.events) + ".")
+		return "\n\n".join(lines)
+
+# build the messages requesting the next paragraph of a story about
+# `premise` while keeping only the last `keep_last` paragraphs in full.
+# `outline` is the guided story's outline, or None for an unguided story
+def bounded_story_messages(system_message, premise, prompts, paragraphs, keep_last, outline=None):
+	messages = [system_message]
+	if paragraphs:
+		state = StoryState()
+		first_kept = max(0, len(paragraphs) - keep_last)
+		for i, paragraph in enumerate(paragraphs):
+			state.update(outline[i] if outline else None, paragraph, i < first_kept)
+		summary = "\n\n".join(filter(None, [f"You're writing a story about: {premise}", state.describe()]))
+		messages.append({"role": "user", "content": summary})
+		for paragraph in paragraphs[first_kept:]:
+			messages.append({"role": "user", "content": fulfilled_prompt})
+			messages.append({"role": "assistant", "content": paragraph})
+	messages.append({"role": "user", "content": prompts[len(paragraphs)]})
+	return messages
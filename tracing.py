@@ -0,0 +1,150 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import argparse
+import contextvars
+import json
+import time
+
+# Lightweight request-level instrumentation for the generation pipeline.
+#
+# Code that does something worth measuring wraps it in `span(kind, ...)`;
+# when tracing is enabled (see `enable`) each span is written as one JSON
+# line to the metrics file, along with its wall-clock latency and any tags
+# set by enclosing `tags(...)` blocks (premise, story index, guided or
+# unguided, outline function...). Tags live in a context variable, so they
+# follow each asyncio task rather than leaking between concurrent stories.
+# `python3 tracing.py report metrics.jsonl` summarizes a metrics file.
+
+# USD per million prompt/completion tokens
+prices_per_million = {
+	"gpt-3.5-turbo": (0.50, 1.50),
+	"gpt-4-turbo": (10.00, 30.00),
+	"gpt-4o": (2.50, 10.00),
+	"gpt-4o-mini": (0.15, 0.60),
+}
+# the batch API charges half the interactive price
+batch_discount = 0.5
+
+current_tags = contextvars.ContextVar("current_tags", default={})
+metrics_file = None
+
+# start writing spans to the JSONL file at `path` (appending to it)
+def enable(path):
+	global metrics_file
+	metrics_file = open(path, "a")
+
+def enabled():
+	return metrics_file is not None
+
+# attach `new_tags` to every span recorded inside this block
+@contextmanager
+def tags(**new_tags):
+	token = current_tags.set({**current_tags.get(), **new_tags})
+	try:
+		yield
+	finally:
+		current_tags.reset(token)
+
+def record(kind, **fields):
+	if metrics_file is None:
+		return
+	metrics_file.write(json.dumps({"kind": kind, "time": time.time(), **current_tags.get(), **fields}) + "\n")
+	metrics_file.flush()
+
+# time the enclosed block and record it as a `kind` span. the yielded dict
+# can be used to add fields (token counts, retries...) once they're known
+@contextmanager
+def span(kind, **fields):
+	start = time.perf_counter()
+	try:
+		yield fields
+	finally:
+		record(kind, latency=time.perf_counter() - start, **fields)
+
+# record the token usage of an OpenAI chat completion on a span's fields
+def add_usage(fields, completion):
+	usage = getattr(completion, "usage", None)
+	if usage is not None:
+		fields["prompt_tokens"] = usage.prompt_tokens
+		fields["completion_tokens"] = usage.completion_tokens
+
+def cost(record):
+	prompt_price, completion_price = prices_per_million.get(record.get("model"), (0, 0))
+	dollars = (record.get("prompt_tokens", 0) * prompt_price + record.get("completion_tokens", 0) * completion_price) / 1e6
+	return dollars * batch_discount if record.get("batch") else dollars
+
+### Reporting
+
+def percentile(sorted_values, q):
+	if not sorted_values:
+		return float("nan")
+	return sorted_values[min(len(sorted_values) - 1, int(q / 100 * len(sorted_values)))]
+
+def load_records(path):
+	with open(path) as file:
+		return [json.loads(line) for line in file if line.strip()]
+
+def print_table(header, rows):
+	widths = [max(len(str(row[i])) for row in [header] + rows) for i in range(len(header))]
+	for row in [header] + rows:
+		print("  ".join(str(cell).ljust(width) for cell, width in zip(row, widths)))
+	print()
+
+def report(records):
+	latencies = defaultdict(list)
+	for record in records:
+		if record.get("latency") is not None and not record.get("cached"):
+			latencies[record["kind"]].append(record["latency"])
+	print("Latency (seconds, excluding cache hits)")
+	print_table(["kind", "count", "p50", "p90", "p99", "max"], [
+		[kind, len(values)] + [f"{percentile(sorted(values), q):.3f}" for q in (50, 90, 99, 100)]
+		for kind, values in sorted(latencies.items())
+	])
+
+	completions = [record for record in records if record["kind"] == "completion"]
+	waits = sorted(record["queue_wait"] for record in completions if record.get("queue_wait") is not None)
+	if waits:
+		print(f"Queue wait: p50 {percentile(waits, 50):.3f}s, p90 {percentile(waits, 90):.3f}s, max {waits[-1]:.3f}s")
+	print(f"Retries: {sum(record.get('retries') or 0 for record in completions)}")
+	print(f"Cache hits: {sum(1 for record in completions if record.get('cached'))} of {len(completions)} completions")
+	print()
+
+	by_function = defaultdict(lambda: [0, 0, 0, 0.0])
+	for record in completions:
+		function = record.get("function")
+		if function is None:
+			function = "(unguided)" if record.get("story_kind") == "unguided" else f"({record.get('purpose', 'other')})"
+		totals = by_function[function]
+		totals[0] += 1
+		totals[1] += record.get("prompt_tokens", 0)
+		totals[2] += record.get("completion_tokens", 0)
+		totals[3] += cost(record)
+	print("Tokens by outline function")
+	print_table(["function", "calls", "prompt", "completion", "prompt/call", "cost"], [
+		[function, calls, prompt, completion, prompt // max(calls, 1), f"${dollars:.4f}"]
+		for function, (calls, prompt, completion, dollars) in sorted(by_function.items(), key=lambda item: -item[1][3])
+	])
+
+	by_story = defaultdict(float)
+	for record in completions:
+		if record.get("story") is not None:
+			by_story[(record.get("premise"), record["story"], record.get("story_kind"))] += cost(record)
+	by_kind = defaultdict(list)
+	for (premise, story, story_kind), dollars in by_story.items():
+		by_kind[story_kind].append(dollars)
+	print("Cost per story")
+	print_table(["kind", "stories", "mean", "max", "total"], [
+		[story_kind, len(values), f"${sum(values) / len(values):.4f}", f"${max(values):.4f}", f"${sum(values):.4f}"]
+		for story_kind, values in sorted(by_kind.items())
+	])
+	print(f"Total cost: ${sum(cost(record) for record in completions):.4f}")
+
+def main(argv=None, prog=None):
+	parser = argparse.ArgumentParser(prog=prog, description="Summarize a pipeline metrics file.")
+	parser.add_argument("command", choices=["report"])
+	parser.add_argument("metrics", help="JSONL metrics file written with --metrics")
+	args = parser.parse_args(argv)
+	report(load_records(args.metrics))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,148 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+import argparse
+import json
+import random
+import urllib.error
+import urllib.request
+
+# A long-lived local worker that keeps the slow-to-load parts of the pipeline
+# warm between invocations: the sentence embedding model (and embedding
+# store) used for evaluation, and the grounded plotgen.lp program used for
+# outline sampling. Loading the model alone takes several seconds, so
+# repeated evals and samples are much faster against a running worker:
+#
+#   python3 spleenwort.py worker
+#   python3 spleenwort.py eval --worker
+#   python3 spleenwort.py sample -n 5 --worker
+#
+# Requests and responses are JSON over HTTP on the loopback interface. The
+# worker answers one request at a time, since neither the model nor the
+# clingo Control should be used from several threads at once. This module
+# only imports the standard library, so clients stay cheap to start; the
+# server imports the heavy dependencies when it starts.
+
+default_port = 8770
+default_url = f"http://127.0.0.1:{default_port}"
+
+### Client
+
+# send one JSON request to the worker at `url` and return its JSON response
+def call(url, endpoint, body):
+	request = urllib.request.Request(
+		f"{url.rstrip('/')}/{endpoint}",
+		data=json.dumps(body).encode("utf-8"),
+		headers={"Content-Type": "application/json"}
+	)
+	try:
+		with urllib.request.urlopen(request) as response:
+			return json.loads(response.read())
+	except urllib.error.HTTPError as error:
+		raise ValueError(json.loads(error.read())["error"]) from None
+	except urllib.error.URLError as error:
+		raise ConnectionError(f"no worker at {url} ({error.reason}); start one with `python3 spleenwort.py worker`") from None
+
+# worker version of `OutlineSampler.sample`; `seed` makes a call reproducible
+def sample(url, n=1, require=(), forbid=(), scenes=None, num_scenes=None, unique=True, seed=None):
+	return call(url, "sample", {
+		"n": n, "require": list(require), "forbid": list(forbid), "scenes": scenes,
+		"num_scenes": num_scenes, "unique": unique, "seed": seed
+	})["outlines"]
+
+# worker version of `eval.evaluate_batches`
+def evaluate_batches(url, batches, batch_size=64, indices=None):
+	return call(url, "eval", {"batches": batches, "batch_size": batch_size, "indices": indices})["scores"]
+
+### Server
+
+class WorkerHandler(BaseHTTPRequestHandler):
+	def log_message(self, format, *args):
+		pass
+
+	def send_json(self, status, body):
+		payload = json.dumps(body).encode("utf-8")
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(payload)))
+		self.end_headers()
+		self.wfile.write(payload)
+
+	def do_GET(self):
+		if self.path.rstrip("/") != "/health":
+			self.send_json(404, {"error": f"unknown endpoint {self.path}"})
+			return
+		self.send_json(200, {"ok": True, "requests": self.server.requests})
+
+	def do_POST(self):
+		handlers = {"/sample": self.server.sample, "/eval": self.server.evaluate}
+		handler = handlers.get(self.path.rstrip("/"))
+		if handler is None:
+			self.send_json(404, {"error": f"unknown endpoint {self.path}"})
+			return
+		self.server.requests += 1
+		# always answer, so clients get an error message rather than a
+		# dropped connection: 400 for malformed requests, 500 for failures
+		try:
+			if self.headers["Content-Length"] is None:
+				raise ValueError("missing Content-Length")
+			request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+			response = handler(request)
+		except (KeyError, TypeError, ValueError) as error:
+			self.send_json(400, {"error": f"bad request: {error}"})
+			return
+		except Exception as error:
+			self.send_json(500, {"error": f"{type(error).__name__}: {error}"})
+			return
+		self.send_json(200, response)
+
+class Worker(HTTPServer):
+	def __init__(self, port=default_port, store="embeddings", preload=True):
+		super().__init__(("127.0.0.1", port), WorkerHandler)
+		import eval as evaluation
+		from embedding_store import EmbeddingStore
+		from outline_sampler import OutlineSampler
+		self.evaluation = evaluation
+		self.store = None if store is None else EmbeddingStore(Path(store) / evaluation.MODEL_NAME, evaluation.MODEL_NAME)
+		self.sampler = OutlineSampler()
+		self.requests = 0
+		if preload:
+			evaluation.get_model()
+			self.sampler.control()
+
+	@property
+	def url(self):
+		return f"http://127.0.0.1:{self.server_address[1]}"
+
+	def sample(self, request):
+		rng = random.Random(request["seed"]) if request.get("seed") is not None else None
+		scenes = {int(scene): label for scene, label in (request.get("scenes") or {}).items()}
+		outlines = self.sampler.sample(
+			request.get("n", 1), request.get("require", ()), request.get("forbid", ()), scenes,
+			request.get("num_scenes"), request.get("unique", True), rng
+		)
+		return {"outlines": outlines}
+
+	def evaluate(self, request):
+		scores = self.evaluation.evaluate_batches(
+			request["batches"], request.get("batch_size", 64), self.store, request.get("indices")
+		)
+		return {"scores": scores}
+
+def main(argv=None, prog=None):
+	parser = argparse.ArgumentParser(prog=prog, description="Serve outline sampling and homogeneity evaluation from a warm local worker.")
+	parser.add_argument("--port", type=int, default=default_port)
+	parser.add_argument("--store", default="embeddings", help="embedding store directory, as for eval")
+	parser.add_argument("--no-store", action="store_true", help="embed every passage from scratch")
+	parser.add_argument("--lazy", action="store_true", help="load the model and ground plotgen.lp on first use instead of at startup")
+	args = parser.parse_args(argv)
+	worker = Worker(args.port, None if args.no_store else args.store, not args.lazy)
+	print(f"Worker ready at {worker.url}")
+	try:
+		worker.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		worker.server_close()
+
+if __name__ == "__main__":
+	main()